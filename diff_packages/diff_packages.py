@@ -6,6 +6,10 @@ import tarfile
 import json
 import io
 
+sys.path.append("/usr/local/lib")
+
+from freenasOS.PackageFile import NormalizePath
+
 kPkgNameKey = "name"
 kPkgVersionKey = "version"
 kPkgFilesKey = "files"
@@ -180,9 +184,12 @@ def DiffPackageFiles(pkg1, pkg2, output_file = None):
 
     # Now copy files from pkg2 to new_tf
     # We want to do this by going through pkg2_tarfile.
-    search_dict = dict(diffs[kPkgFilesKey], ** diffs[kPkgDirsKey])
+    search_dict = {}
+    for key in (kPkgFilesKey, kPkgDirsKey):
+        for (name, value) in diffs[key].items():
+            search_dict[NormalizePath(name)] = value
     while member is not None:
-        fname = member.name if member.name in search_dict else "/" + member.name
+        fname = NormalizePath(member.name)
         if fname in search_dict:
             if member.issym() or member.islnk():
             # A link
@@ -200,7 +207,7 @@ def DiffPackageFiles(pkg1, pkg2, output_file = None):
             search_dict.pop(fname)
             if len(search_dict) == 0:
                 break
-        member = next(pkg2_tarfile)
+        member = pkg2_tarfile.next()
     new_tf.close()
     return output_file
 
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
+import atexit
 import getopt
+import json
 import logging
 import os
 import sys
@@ -11,6 +13,7 @@ sys.path.append("/usr/local/lib")
 import freenasOS.Configuration as Configuration
 import freenasOS.Update as Update
 import freenasOS.Exceptions as Exceptions
+import freenasOS.Mirror as Mirror
 from freenasOS import log_to_handler
 from freenasOS.Installer import ProgressHandler
 
@@ -150,7 +153,7 @@ def PrintDifferences(diffs):
             print("*** Unknown key {0} (value {1})".format(type, str(diffs[type])), file=sys.stderrr)
 
 
-def DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=False):
+def DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=False, workers=1):
 
     try:
         if not verbose:
@@ -162,11 +165,13 @@ def DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=False):
                     get_handler=handler.get_handler,
                     check_handler=handler.check_handler,
                     pkg_type=pkg_type,
+                    workers=workers,
                 )
                 if rv is False:
                     progress_bar.update(message="No updates available")
         else:
-            rv = Update.DownloadUpdate(train, cache_dir, pkg_type=pkg_type, ignore_space=ignore_space)
+            rv = Update.DownloadUpdate(train, cache_dir, pkg_type=pkg_type, ignore_space=ignore_space,
+                                       workers=workers)
     except Exceptions.ManifestInvalidSignature:
         log.error("Manifest has invalid signature")
         print("Manifest has invalid signature", file=sys.stderr)
@@ -199,7 +204,7 @@ def DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=False):
     return rv
 
 
-def DoUpdate(cache_dir, verbose, ignore_space=False, force_trampoline=None):
+def DoUpdate(cache_dir, verbose, ignore_space=False, force_trampoline=None, pipeline=False):
     """
     Common code to apply an update once it's been downloaded.
     This will handle all of the exceptions in a common fashion.
@@ -234,6 +239,7 @@ def DoUpdate(cache_dir, verbose, ignore_space=False, force_trampoline=None):
                     install_handler=handler.install_handler,
                     ignore_space=ignore_space,
                     force_trampoline=force_trampoline,
+                    pipeline=pipeline,
                 )
                 if rv is False:
                     progress_bar.update(message="Updates were not applied")
@@ -243,6 +249,7 @@ def DoUpdate(cache_dir, verbose, ignore_space=False, force_trampoline=None):
                                           progressFunc=pf.update,
                                           ignore_space=ignore_space,
                                           force_trampoline=force_trampoline,
+                                          pipeline=pipeline,
                                           )
                   
     except Exceptions.UpdateInsufficientSpace as e:
@@ -261,15 +268,17 @@ def main():
     global log
 
     def usage():
-        print("""Usage: {0} [-C cache_dir] [-d] [-T train] [--no-delta] [--reboot|-R] [--server|-S server][-B|--trampoline yes|no] [--force|-F] [-v] <cmd>
+        print("""Usage: {0} [-C cache_dir] [-d] [-T train] [--no-delta] [--reboot|-R] [--server|-S server][-B|--trampoline yes|no] [--force|-F] [-j|--jobs N] [--limit-rate rate[K|M]] [--limit-schedule HH:MM-HH:MM[,...]] [--stats] [--pipeline] [--mirror-dir dir] [--listen [addr:]port] [-v] <cmd>
 or	{0} <update_tar_file>
 where cmd is one of:
         check\tCheck for updates
-        update\tDo an update""".format(sys.argv[0]), file=sys.stderr)
+        update\tDo an update
+        serve\tServe a local mirror of the update server
+        sync\tBring the local mirror up to date (all trains, or -T train)""".format(sys.argv[0]), file=sys.stderr)
         sys.exit(1)
 
     try:
-        short_opts = "B:C:dFRS:T:v"
+        short_opts = "B:C:dFj:RS:T:v"
         long_opts = [
             "cache=",
             "debug",
@@ -280,6 +289,13 @@ where cmd is one of:
             "force",
             "server=",
             "trampoline=",
+            "jobs=",
+            "limit-rate=",
+            "limit-schedule=",
+            "stats",
+            "pipeline",
+            "mirror-dir=",
+            "listen=",
             "snl"
         ]
         opts, args = getopt.getopt(sys.argv[1:], short_opts, long_opts)
@@ -299,6 +315,14 @@ where cmd is one of:
     force = False
     server = None
     force_trampoline = None
+    workers = 1
+    limit_rate = None
+    limit_schedule = None
+    print_stats = False
+    pipeline = False
+    mirror_dir = Mirror.DEFAULT_MIRROR_DIR
+    listen_address = Mirror.DEFAULT_LISTEN_ADDRESS
+    listen_port = Mirror.DEFAULT_LISTEN_PORT
     
     for o, a in opts:
         if o in ("-v", "--verbose"):
@@ -323,6 +347,33 @@ where cmd is one of:
             else:
                 print("Trampoline option must be boolean [yes/no]", file=sys.stderr)
                 usage()
+        elif o in ("-j", "--jobs"):
+            try:
+                workers = int(a)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print("Number of download jobs must be a positive integer", file=sys.stderr)
+                usage()
+        elif o in ("--limit-rate"):
+            limit_rate = a
+        elif o in ("--limit-schedule"):
+            limit_schedule = a
+        elif o in ("--stats"):
+            print_stats = True
+        elif o in ("--pipeline"):
+            pipeline = True
+        elif o in ("--mirror-dir"):
+            mirror_dir = a
+        elif o in ("--listen"):
+            (addr, _, port) = a.rpartition(":")
+            try:
+                listen_port = int(port)
+            except ValueError:
+                print("Listen port must be an integer", file=sys.stderr)
+                usage()
+            if addr:
+                listen_address = addr
         elif o in ("--snl"):
             snl = True
         elif o in ("-F", "--force"):
@@ -338,7 +389,20 @@ where cmd is one of:
     if server:
         assert server in config.ListUpdateServers(), "Unknown update server {}".format(server)
         config.SetUpdateServer(server, save=False)
+    if limit_rate is not None or limit_schedule is not None:
+        try:
+            config.SetBandwidthLimit(limit_rate, limit_schedule, save=False)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            usage()
+    if print_stats:
+        # Print the network transfer summary, as JSON, however we exit.
+        def PrintStats():
+            print(json.dumps(config.TransferSummary(), indent=4, sort_keys=True), file=sys.stderr)
+        atexit.register(PrintStats)
         
+    # Syncing the mirror does all of the trains, unless one was given.
+    sync_trains = [train] if train else None
     if train is None:
         train = config.SystemManifest().Train()
 
@@ -352,7 +416,7 @@ where cmd is one of:
         # we make a temporary directory and use that.  We
         # have to clean up afterwards in that case.
 
-        rv = DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=force)
+        rv = DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=force, workers=workers)
         if rv is False:
             if verbose:
                 print("No updates available")
@@ -368,6 +432,30 @@ where cmd is one of:
                 print("I've got a fever, and the only prescription is applying the pending update.")
             sys.exit(0)
 
+    elif args[0] == "serve":
+        # Serve a mirror of the update server, filled on demand,
+        # for other systems on the network to update from.
+        try:
+            Mirror.Serve(mirror_dir, address=listen_address, port=listen_port, conf=config)
+        except KeyboardInterrupt:
+            sys.exit(0)
+        except OSError as e:
+            print("Unable to serve {0}: {1}".format(mirror_dir, str(e)), file=sys.stderr)
+            sys.exit(1)
+
+    elif args[0] == "sync":
+        try:
+            synced = Mirror.SyncMirror(mirror_dir, trains=sync_trains, conf=config,
+                                       workers=workers,
+                                       deltas=(pkg_type != Update.PkgFileFullOnly))
+        except BaseException as e:
+            print("Unable to sync {0}: {1}".format(mirror_dir, str(e)), file=sys.stderr)
+            sys.exit(1)
+        for name in sorted(synced):
+            print("{0}: {1} ({2} files, {3} bytes fetched)".format(
+                name, synced[name]["Sequence"], synced[name]["Files"], synced[name]["Bytes"]))
+        sys.exit(0)
+
     elif args[0] == "update":
         # This will attempt to apply an update.
         # If cache_dir is given, then we will only check that directory,
@@ -393,7 +481,7 @@ where cmd is one of:
             raise
 
         if do_download:
-            rv = DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=force)
+            rv = DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=force, workers=workers)
             if rv is False:
                 if verbose:
                     print("No updates available")
@@ -401,7 +489,8 @@ where cmd is one of:
                 sys.exit(1)
 
         try:
-            rv = DoUpdate(cache_dir, verbose, ignore_space=force, force_trampoline=force_trampoline)
+            rv = DoUpdate(cache_dir, verbose, ignore_space=force, force_trampoline=force_trampoline,
+                          pipeline=pipeline)
         except:
             sys.exit(1)
         else:
@@ -440,7 +529,8 @@ where cmd is one of:
             print("Unable to extract frozen update {0}: {1}".format(args[0], str(e)))
             sys.exit(1)
         try:
-            rv = DoUpdate(cache_dir, verbose, ignore_space=force, force_trampoline=force_trampoline)
+            rv = DoUpdate(cache_dir, verbose, ignore_space=force, force_trampoline=force_trampoline,
+                          pipeline=pipeline)
         except:
             sys.exit(1)
         else:
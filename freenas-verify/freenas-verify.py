@@ -1,12 +1,80 @@
 #!/usr/bin/env /usr/local/bin/python
 from __future__ import print_function
+import getopt
+import os
 import sys
 import traceback
 
 sys.path.append("/usr/local/lib")
 from freenasOS import Configuration
 
+
+def usage():
+    print("""Usage: {0}
+or	{0} -c|--compare other [base]
+where other and base are boot environment names, or the roots of
+mounted ones; base is the running system if not given.""".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+def compare(other, base=None):
+    # Print the package and file entries that differ between
+    # the pkgdbs of base and other, as they're found.  Boot
+    # environments that aren't already mounted are mounted
+    # for as long as this takes.  Neither pkgdb is changed.
+    mounted = []
+
+    def root_of(name):
+        if name is None or os.path.isdir(name):
+            return name
+        from freenasOS import Update
+        mount_point = Update.MountClone(name)
+        if mount_point is None:
+            raise IOError("Unable to mount boot environment {0}".format(name))
+        mounted.append((name, mount_point))
+        return mount_point
+
+    differ = False
+    try:
+        pkgdb = Configuration.PackageDB(root_of(base), create=False)
+        other_root = root_of(other)
+        for (name, version, other_version) in pkgdb.ComparePackages(other_root):
+            differ = True
+            print("Package {0}: {1} -> {2}".format(name, version or "(none)", other_version or "(none)"))
+        for (path, entry, other_entry, changes) in pkgdb.CompareFiles(other_root):
+            differ = True
+            if entry is None:
+                print("A {0}".format(path))
+            elif other_entry is None:
+                print("D {0}".format(path))
+            else:
+                print("M {0}\t{1}".format(path, ", ".join(changes)))
+    finally:
+        for (name, mount_point) in mounted:
+            from freenasOS import Update
+            Update.UnmountClone(name, mount_point)
+    return differ
+
+
 if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c", ["compare"])
+    except getopt.GetoptError as err:
+        print(str(err), file=sys.stderr)
+        usage()
+
+    if opts:
+        if len(args) not in (1, 2):
+            usage()
+        try:
+            differ = compare(*args)
+        except Exception:
+            traceback.print_exc()
+            sys.exit(74)
+        sys.exit(1 if differ else 0)
+    elif args:
+        usage()
+
     try:
         error_flag, ed, warn_flag, wl = Configuration.do_verify()
     except IOError as e:
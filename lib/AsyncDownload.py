@@ -0,0 +1,244 @@
+from __future__ import print_function
+import asyncio
+import functools
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import freenasOS.Configuration as Configuration
+from freenasOS.Exceptions import (
+    UpdateDownloadCancelledException,
+    UpdateManifestNotFound,
+)
+
+log = logging.getLogger('freenasOS.AsyncDownload')
+
+# How many network operations an AsyncDownloader runs at once.
+DEFAULT_CONCURRENCY = 4
+
+def RunSync(coro):
+    """
+    Run coro to completion and return its result, from synchronous
+    code.  If this thread already has a running event loop (so
+    asyncio.run() can't be used), it's run on a new thread instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result = {}
+    def runner():
+        try:
+            result["value"] = asyncio.run(coro)
+        except BaseException as e:
+            result["error"] = e
+    t = threading.Thread(target=runner, name="freenasOS-RunSync")
+    t.start()
+    t.join()
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+class AsyncDownloader(object):
+    """
+    asyncio interface to the update network operations:  manifests
+    (and the CRL, fetched when their signatures are verified),
+    validation programs, package files, and the changelog.
+
+    The transfers themselves are done by Configuration (and so use
+    its pooled session, mirrors, rate limit, and package store) on a
+    private thread pool; at most concurrency of them run at once,
+    however many coroutines are waiting.  Cancelling a coroutine sets
+    the cancel event passed to the transfer, and waits for it to stop,
+    so partial files are left ready to resume.
+
+    conf is the Configuration to use; each pool or jail being checked
+    can have its own, with one AsyncDownloader each, all on one loop.
+    """
+    def __init__(self, conf=None, concurrency=DEFAULT_CONCURRENCY):
+        if conf is None:
+            conf = Configuration.SystemConfiguration()
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self._conf = conf
+        self._concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Configuration(self):
+        return self._conf
+
+    def Close(self):
+        # Waits for any transfers still running.
+        self._executor.shutdown(wait=True)
+        return
+
+    def _Semaphore(self):
+        # Semaphores belong to a loop (before Python 3.10), so
+        # make a new one if we're used from a different loop.
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def Call(self, func, *args, cancel=None, **kwargs):
+        """
+        Run func(*args, **kwargs) on the thread pool, within the
+        concurrency limit.  If cancel (a threading.Event) is given,
+        it's also passed to func; when this coroutine is cancelled,
+        the event is set, and func is given a chance to stop.
+        """
+        loop = asyncio.get_running_loop()
+        if cancel is not None:
+            kwargs["cancel"] = cancel
+        async with self._Semaphore():
+            future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if cancel is not None:
+                    cancel.set()
+                    try:
+                        await future
+                    except BaseException:
+                        pass
+                raise
+
+    async def GetNetworkFile(self, **kwargs):
+        """
+        Asynchronous Configuration.TryGetNetworkFile; takes the same
+        keyword arguments (cancel is supplied, if not given).
+        """
+        cancel = kwargs.pop("cancel", None) or threading.Event()
+        return await self.Call(self._conf.TryGetNetworkFile, cancel=cancel, **kwargs)
+
+    async def FindLatestManifest(self, train=None, require_signature=False):
+        return await self.Call(self._conf.FindLatestManifest,
+                               train=train, require_signature=require_signature)
+
+    async def RunValidationProgram(self, manifest, cache_dir, kind=None):
+        from . import Manifest
+        if kind is None:
+            kind = Manifest.VALIDATE_UPDATE
+        return await self.Call(manifest.RunValidationProgram, cache_dir, kind=kind)
+
+    async def FindPackageFile(self, package, cancel=None, **kwargs):
+        """
+        Asynchronous Configuration.FindPackageFile; takes the same
+        keyword arguments.
+        """
+        return await self.Call(self._conf.FindPackageFile, package,
+                               cancel=cancel or threading.Event(), **kwargs)
+
+    async def GetChangeLog(self, train, save_dir=None, handler=None):
+        return await self.Call(self._conf.GetChangeLog, train,
+                               save_dir=save_dir, handler=handler)
+
+    async def CheckForUpdates(self, train=None):
+        """
+        Like Update.CheckForUpdates (without a cache directory), but
+        for this downloader's configuration.  Returns the new manifest,
+        or None if there is no update.
+        """
+        from .Update import GetUpdateChanges
+
+        manifest = await self.FindLatestManifest(train=train, require_signature=True)
+        if manifest is None:
+            raise UpdateManifestNotFound("Manifest could not be found!")
+        if train and train != manifest.Train():
+            log.debug("CheckForUpdates(train = %s):  Wrong train (%s)" % (train, manifest.Train()))
+            return None
+        await self.RunValidationProgram(manifest, None)
+        diffs = GetUpdateChanges(self._conf.SystemManifest(), manifest)
+        if diffs is None or len(diffs) == 0:
+            return None
+        log.debug("CheckForUpdates:  diffs = %s" % diffs)
+        return manifest
+
+    async def DownloadPackages(self, pkgList, directory, get_handler=None,
+                               check_handler=None, pkg_type=None, ignore_space=False):
+        """
+        Download the package files in pkgList into directory, within
+        the concurrency limit.  See Update.DownloadPackages().
+        """
+        from .Update import DownloadProgress
+
+        cancel = threading.Event()
+        progress = DownloadProgress(pkgList, check_handler=check_handler, get_handler=get_handler)
+        errors = []
+
+        async def fetch(indx, pkg):
+            try:
+                if cancel.is_set():
+                    raise UpdateDownloadCancelledException("Download of %s cancelled" % pkg.Name())
+                pkg_file = await self.Call(
+                    self._conf.FindPackageFile, pkg, save_dir=directory,
+                    handler=progress.Handler(indx) if (get_handler or check_handler) else None,
+                    pkg_type=pkg_type, ignore_space=ignore_space, cancel=cancel,
+                )
+                pkg_file.close()
+                progress.Finished(indx)
+            except UpdateDownloadCancelledException as e:
+                errors.append(e)
+                raise
+            except Exception as e:
+                log.error("Could not download package file for %s: %s" % (pkg.Name(), str(e)))
+                errors.append(e)
+                # The first failure stops the rest.
+                cancel.set()
+                raise
+
+        progress.Start()
+        tasks = [asyncio.ensure_future(fetch(indx, pkg)) for indx, pkg in enumerate(pkgList)]
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            cancel.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # Anything fetch() didn't see (e.g., a task cancelled on its own).
+        for result in results:
+            if isinstance(result, BaseException) and result not in errors:
+                errors.append(result)
+        if errors:
+            # Report the first real failure, rather than the cancellations it caused.
+            for e in errors:
+                if not isinstance(e, UpdateDownloadCancelledException):
+                    raise e
+            raise errors[0]
+        return True
+
+    async def DownloadUpdate(self, train, directory, **kwargs):
+        """
+        Update.DownloadUpdate, run without blocking the loop.  Like the
+        synchronous version, it uses the system configuration.  The
+        manifest handling runs on a thread of its own; the package
+        files are fetched by this downloader's DownloadPackages(), on
+        this loop, so there's no second loop or thread pool.
+        """
+        from .Update import DownloadUpdate
+
+        loop = asyncio.get_running_loop()
+
+        def download(conf, pkgList, directory, workers=None, **kwargs):
+            # Called from DownloadUpdate's thread; waits for the
+            # coroutine, on our loop, to finish.
+            return asyncio.run_coroutine_threadsafe(
+                self.DownloadPackages(pkgList, directory, **kwargs), loop).result()
+
+        kwargs["workers"] = self._concurrency
+        kwargs["downloader"] = download
+        # Not through Call():  it would hold one of the transfer
+        # slots while its own transfers wait for them.
+        return await loop.run_in_executor(None, functools.partial(DownloadUpdate, train, directory, **kwargs))
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import collections
 import hashlib
 import logging
 import os
@@ -6,6 +7,7 @@ import re
 import sys
 import tempfile
 import time
+import threading
 import socket
 import ssl
 import six
@@ -14,10 +16,12 @@ import six.moves.configparser as configparser
 
 from http.client import REQUESTED_RANGE_NOT_SATISFIABLE as HTTP_RANGE
 from http.client import NOT_FOUND as HTTP_NOT_FOUND
+from http.client import NOT_MODIFIED as HTTP_NOT_MODIFIED
+from http.client import PARTIAL_CONTENT as HTTP_PARTIAL_CONTENT
 
 from . import (
     Avatar, UPDATE_SERVER, MASTER_UPDATE_SERVER, Exceptions,
-    Installer, Train, Package, Manifest, DEFAULT_CA_FILE
+    Installer, Train, Package, Manifest, PackageStore, DEFAULT_CA_FILE
 )
 
 from stat import (
@@ -40,11 +44,15 @@ VERIFY_SKIP_PATHS = [
 CONFIG_DEFAULT = "Defaults"
 CONFIG_SEARCH = "Search"
 CONFIG_SERVER = "update_server"
+CONFIG_BANDWIDTH_LIMIT = "bandwidth_limit"
+CONFIG_BANDWIDTH_SCHEDULE = "bandwidth_schedule"
+CONFIG_PACKAGE_STORE_SIZE = "package_store_size"
 
 UPDATE_SERVER_NAME_KEY = "name"
 UPDATE_SERVER_MASTER_KEY = "master"
 UPDATE_SERVER_URL_KEY = "url"
 UPDATE_SERVER_SIGNED_KEY = "signing"
+UPDATE_SERVER_MIRRORS_KEY = "mirrors"
 
 TRAIN_DESC_KEY = "Descripton"
 TRAIN_SEQ_KEY = "Sequence"
@@ -52,9 +60,68 @@ TRAIN_CHECKED_KEY = "LastChecked"
 
 log = logging.getLogger('freenasOS.Configuration')
 
+# Connection pooling for network requests.  We talk to at most
+# a couple of hosts (the update server and the master), but
+# may have several transfers going to the same one.
+NETWORK_POOL_HOSTS = 4
+NETWORK_POOL_SIZE = 8
+
+# Seconds to wait to connect, or for more data, before giving
+# up on a server (and moving on to the next mirror, if any).
+NETWORK_TIMEOUT = 10
+
+# Mirror selection.  Each server's latency (time to response headers)
+# and throughput are kept as an exponentially-weighted moving average;
+# a request goes to the mirror with the lowest expected time to fetch
+# MIRROR_SCORE_SIZE bytes.  Each consecutive failure adds
+# MIRROR_FAILURE_PENALTY seconds.  Servers we haven't heard from yet
+# cost nothing, so each one gets tried.
+MIRROR_EWMA_WEIGHT = 0.3
+MIRROR_SCORE_SIZE = 1024 * 1024
+MIRROR_FAILURE_PENALTY = 30.0
+
+# Files at least NETWORK_SEGMENT_THRESHOLD bytes long, from servers that
+# support range requests, are fetched as NETWORK_SEGMENTS parallel byte
+# ranges.  The progress of each range is kept in a file next to the
+# download (with SEGMENT_STATE_SUFFIX appended), so it can be resumed.
+NETWORK_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+NETWORK_SEGMENTS = 4
+SEGMENT_STATE_SUFFIX = ".segments"
+
+# How many of the most recent transfers' statistics are kept, so
+# long-running processes don't keep growing.
+TRANSFER_STATS_LIMIT = 1000
+
+# Resumable (intr_ok) downloads keep a checkpoint next to the partial
+# file (with CHECKPOINT_SUFFIX appended):  the SHA256 of each
+# CHECKPOINT_BLOCK_SIZE block written so far, and of the bytes after
+# the last whole block.  On resume, the partial file is checked
+# against it, and cut back to the last good block.
+CHECKPOINT_BLOCK_SIZE = 4 * 1024 * 1024
+CHECKPOINT_SUFFIX = ".ckpt"
+
+# Choosing between delta and full packages (see PlanPackageSources).
+# Until we've measured the network, assume PLANNER_DEFAULT_LATENCY
+# seconds and PLANNER_DEFAULT_THROUGHPUT bytes/second; local copies
+# are read (to check them) at PLANNER_LOCAL_THROUGHPUT.  A delta has
+# to be expected to save at least PLANNER_DELTA_SAVING of the cost.
+PLANNER_DEFAULT_LATENCY = 0.5
+PLANNER_DEFAULT_THROUGHPUT = 1024 * 1024
+PLANNER_LOCAL_THROUGHPUT = 100 * 1024 * 1024
+PLANNER_DELTA_SAVING = 0.2
+
+# Conditional-GET cache for small, frequently polled files
+# (manifests).  It lives in the temporary directory; each
+# entry is the body, named by the SHA256 of the URL, and a
+# JSON sidecar with the validators the server gave us.
+NETWORK_CACHE_DIR = "network-cache"
+
 # List of trains
 TRAIN_FILE = "trains.txt"
 
+# How many trains CheckTrains() checks at once.
+TRAIN_CHECK_WORKERS = 4
+
 def CheckFreeSpace(path=None, pool=None, required=0):
     """
     Check for enough free space on the path/pool.
@@ -127,18 +194,82 @@ def TryOpenFile(path):
     else:
         return f
 
+def _ReadOnlyURI(path):
+    # An sqlite URI to open the database at path read-only.
+    from six.moves.urllib.parse import quote
+    return "file:{0}?mode=ro".format(quote(os.path.abspath(path)))
+
+
+class PackageFileEntry(object):
+    """
+    One row of the pkgdb files table, as returned by
+    PackageDB.IterFiles().  It's indexed like the dicts
+    FindFilesForPackage() returns (entry["path"]), and
+    dict(entry) makes one of those.
+    """
+    __slots__ = ("path", "package", "kind", "checksum", "uid", "gid", "flags", "mode")
+
+    def __init__(self, row):
+        (self.path, self.package, self.kind, self.checksum,
+         self.uid, self.gid, self.flags, self.mode) = row
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return "PackageFileEntry({0})".format(dict(self))
+
+    def keys(self):
+        return list(self.__slots__)
+
+
 class PackageDB:
+    """
+    The package database for a root.  Normally each method opens the
+    database, and closes (and so commits) it when it's done.  Used as
+    a context manager, it's instead a session:  one connection (and its
+    cache of prepared statements) is kept open, and the changes are one
+    transaction, committed by Commit() and when the session ends, or
+    rolled back by Rollback() or an exception.  Sessions can be nested;
+    only the outermost one ends the transaction.
+    """
     DB_NAME = "data/pkgdb/freenas-db"
+    # How many paths RemoveFileEntries() deletes per statement;
+    # older sqlite builds allow at most 999 parameters.
+    REMOVE_BATCH_SIZE = 500
+    # The schema version, kept in the database's user_version.
+    # Each entry in MIGRATIONS upgrades the schema by one version;
+    # PackageDB() applies any a database doesn't have yet.
+    SCHEMA_VERSION = 1
+    # How many rows IterFiles() reads at a time.
+    ITER_BATCH_SIZE = 1000
+    MIGRATIONS = [
+        # 0 -> 1:  index the package columns, so per-package
+        # lookups and removals don't scan every row.
+        [
+            "CREATE INDEX IF NOT EXISTS files_package ON files(package)",
+            "CREATE INDEX IF NOT EXISTS scripts_package ON scripts(package, type)",
+        ],
+    ]
     __db_path = None
     __db_root = ""
     __conn = None
     __close = True
+    __session = 0
+    __vacuum = False
+    __readonly = False
 
     def __init__(self, root="", create=True):
+        # With create False, the database has to exist already, and
+        # it's opened read-only:  it isn't changed (or upgraded).
         if root is None:
             root = ""
         self.__db_root = root
         self.__db_path = self.__db_root + "/" + PackageDB.DB_NAME
+        self.__readonly = not create
         if os.path.exists(os.path.dirname(self.__db_path)) == False:
             if create is False:
                 raise Exception("Cannot connect to database file {0}".format(self.__db_path))
@@ -147,6 +278,9 @@ class PackageDB:
 
         if self._connectdb(returniferror=True, cursor=False) is None:
             raise Exception("Cannot connect to database file {0}".format(self.__db_path))
+        if self.__readonly:
+            self._closedb()
+            return
 
         cur = self.__conn.cursor()
         cur.execute(
@@ -162,9 +296,171 @@ class PackageDB:
             gid integer,
             flags integer,
             mode integer)""")
+        self._migrate()
+        self._setjournalmode()
+        self._closedb()
+        return
+
+    def _setjournalmode(self):
+        # WAL mode is a property of the database file, so this only
+        # changes anything the first time; it can't be done in a
+        # transaction.
+        try:
+            if self.__conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+                self.__conn.execute("PRAGMA journal_mode = WAL")
+        except Exception as err:
+            log.debug("Cannot use WAL for %s: %s", self.__db_path, str(err))
+        return
+
+    def _migrate(self):
+        # Bring the schema up to SCHEMA_VERSION.  Each step is
+        # its own transaction, along with the new version number.
+        version = self.__conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= PackageDB.SCHEMA_VERSION:
+            return
+        for indx in range(version, PackageDB.SCHEMA_VERSION):
+            log.debug("Upgrading %s to schema version %d", self.__db_path, indx + 1)
+            self.__conn.execute("BEGIN")
+            try:
+                for stmt in PackageDB.MIGRATIONS[indx]:
+                    self.__conn.execute(stmt)
+                self.__conn.execute("PRAGMA user_version = {0}".format(indx + 1))
+            except:
+                self.__conn.execute("ROLLBACK")
+                raise
+            self.__conn.execute("COMMIT")
+        return
+
+    def __enter__(self):
+        self.StartSession()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.EndSession(commit=(type is None))
+
+    def StartSession(self):
+        if self.__session == 0:
+            self._closedb()
+            self._connectdb(isolation_level="DEFERRED")
+            self.__close = False
+        self.__session += 1
+        return
+
+    def EndSession(self, commit=True):
+        if self.__session == 0:
+            return
+        self.__session -= 1
+        if self.__session > 0:
+            return
+        if commit:
+            self.Commit()
+        else:
+            self.Rollback()
+        self.__close = True
         self._closedb()
+        if self.__vacuum:
+            # Deferred from the removals done during the session.
+            self.__vacuum = False
+            self._vacuum()
         return
 
+    def Commit(self):
+        if self.__conn is not None:
+            self.__conn.commit()
+        return
+
+    def Rollback(self):
+        if self.__conn is not None:
+            self.__conn.rollback()
+        return
+
+    def _vacuum(self):
+        # VACUUM can't be done inside a transaction, so in a session
+        # it's left until the session ends.
+        if self.__close is False:
+            self.__vacuum = True
+            return
+        self._connectdb()
+        self.__conn.execute("VACUUM")
+        self._closedb()
+        return
+
+    def DatabasePath(self):
+        return self.__db_path
+
+    def _attach(self, other):
+        # Returns a new connection to this database, with other's
+        # attached as "other".  other is a PackageDB, or the root
+        # it's in; the database has to exist already, and isn't
+        # changed (or upgraded).  Both databases are opened read-only.
+        import sqlite3
+        if isinstance(other, PackageDB):
+            other_path = other.DatabasePath()
+        else:
+            other_path = (other or "") + "/" + PackageDB.DB_NAME
+        if not os.path.exists(other_path):
+            raise Exception("Cannot connect to database file {0}".format(other_path))
+        conn = sqlite3.connect(_ReadOnlyURI(self.__db_path), uri=True)
+        conn.text_factory = str
+        conn.execute("ATTACH DATABASE ? AS other", (_ReadOnlyURI(other_path),))
+        return conn
+
+    def ComparePackages(self, other):
+        # Yields (name, version, other_version), in name order, for
+        # each package that isn't the same in other (see _attach()).
+        # A version is None if the package isn't in that database.
+        conn = self._attach(other)
+        try:
+            cur = conn.execute("""
+            SELECT m.name, m.version, o.version
+                FROM main.packages AS m LEFT JOIN other.packages AS o ON o.name = m.name
+                WHERE o.version IS NOT m.version
+            UNION ALL
+            SELECT o.name, NULL, o.version
+                FROM other.packages AS o
+                WHERE NOT EXISTS (SELECT 1 FROM main.packages WHERE name = o.name)
+            ORDER BY 1""")
+            for row in cur:
+                yield tuple(row)
+        finally:
+            conn.close()
+
+    def CompareFiles(self, other):
+        # Yields (path, entry, other_entry, changes), in path order,
+        # for each file entry that isn't the same in other (see
+        # _attach()).  The entries are PackageFileEntry objects, or
+        # None if the path isn't in that database; changes is a list
+        # of the columns that differ, or None.  This only looks at
+        # the databases, not the files.
+        columns = PackageFileEntry.__slots__
+        conn = self._attach(other)
+        try:
+            cur = conn.execute("""
+            SELECT m.path, {m}, {o}
+                FROM main.files AS m LEFT JOIN other.files AS o ON o.path = m.path
+                WHERE o.path IS NULL OR {differ}
+            UNION ALL
+            SELECT o.path, {nulls}, {o}
+                FROM other.files AS o
+                WHERE NOT EXISTS (SELECT 1 FROM main.files WHERE path = o.path)
+            ORDER BY 1""".format(
+                m=", ".join("m." + c for c in columns),
+                o=", ".join("o." + c for c in columns),
+                nulls=", ".join("NULL" for c in columns),
+                differ=" OR ".join("m.{0} IS NOT o.{0}".format(c) for c in columns[1:]),
+            ))
+            for row in cur:
+                mine = row[1:len(columns) + 1]
+                theirs = row[len(columns) + 1:]
+                entry = PackageFileEntry(mine) if mine[0] is not None else None
+                other_entry = PackageFileEntry(theirs) if theirs[0] is not None else None
+                changes = None
+                if entry and other_entry:
+                    changes = [c for c in columns if entry[c] != other_entry[c]]
+                yield (row[0], entry, other_entry, changes)
+        finally:
+            conn.close()
+
     def _connectdb(self, returniferror=False, cursor=False, isolation_level=None):
         import sqlite3
         if self.__conn is not None:
@@ -172,7 +468,11 @@ class PackageDB:
                 return self.__conn.cursor()
             return True
         try:
-            conn = sqlite3.connect(self.__db_path, isolation_level=isolation_level)
+            if self.__readonly:
+                conn = sqlite3.connect(_ReadOnlyURI(self.__db_path), uri=True,
+                                       isolation_level=isolation_level)
+            else:
+                conn = sqlite3.connect(self.__db_path, isolation_level=isolation_level)
         except Exception as err:
             log.error(
                 "%s:  Cannot connect to database %s: %s",
@@ -186,12 +486,19 @@ class PackageDB:
 
         conn.text_factory = str
         conn.row_factory = sqlite3.Row
+        # With WAL, this is still safe against corruption; only the
+        # most recent commits can be lost if the power fails.
+        if conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            conn.execute("PRAGMA synchronous = NORMAL")
         self.__conn = conn
         if cursor:
             return self.__conn.cursor()
         return True
 
     def _closedb(self):
+        if self.__close is False:
+            # In a session; it stays open.
+            return
         if self.__conn is not None:
             self.__conn.commit()
             self.__conn.close()
@@ -267,21 +574,66 @@ class PackageDB:
         return rv
 
     def FindFilesForPackage(self, pkgName=None):
-        self._connectdb()
-        cur = self.__conn.cursor()
+        # This makes a list of every entry; IterFiles() is
+        # better for anything that can look at them one at a time.
+        return [dict(f) for f in self.IterFiles(pkgName)]
+
+    def IterFileBatches(self, pkgName=None, kind=None, exclude_kind=None,
+                        reverse=False, batch_size=None):
+        # Yields lists of PackageFileEntry objects, in path order
+        # (descending, if reverse is set), optionally only those for
+        # pkgName, and of (or not of) a kind.  Each batch is a new
+        # query, starting after the last path of the one before, so
+        # no more than batch_size rows are in memory at once, and
+        # the caller may change the table in between.
+        if batch_size is None:
+            batch_size = PackageDB.ITER_BATCH_SIZE
+        conditions = []
+        args = []
+        if pkgName is not None:
+            conditions.append("package = ?")
+            args.append(pkgName)
+        if kind is not None:
+            conditions.append("kind = ?")
+            args.append(kind)
+        if exclude_kind is not None:
+            conditions.append("kind <> ?")
+            args.append(exclude_kind)
+        stmt = "SELECT path, package, kind, checksum, uid, gid, flags, mode FROM files WHERE {0} ORDER BY path {1} LIMIT ?"
+        after = None
+        while True:
+            where = list(conditions)
+            where_args = list(args)
+            if after is not None:
+                where.append("path < ?" if reverse else "path > ?")
+                where_args.append(after)
+            self._connectdb()
+            cur = self.__conn.cursor()
+            cur.execute(stmt.format(" AND ".join(where) or "1", "DESC" if reverse else "ASC"),
+                        where_args + [batch_size])
+            batch = [PackageFileEntry(row) for row in cur.fetchall()]
+            self._closedb()
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            after = batch[-1].path
+
+    def IterFiles(self, pkgName=None, **kwargs):
+        # Like IterFileBatches(), but yields the entries one at a time.
+        for batch in self.IterFileBatches(pkgName, **kwargs):
+            for entry in batch:
+                yield entry
+
+    def CountFiles(self, pkgName=None):
+        cur = self._connectdb(cursor=True)
         if pkgName is None:
-            cur.execute("SELECT path, package, kind, checksum, uid, gid, flags, mode FROM files")
+            cur.execute("SELECT COUNT(*) FROM files")
         else:
-            cur.execute("SELECT path, package, kind, checksum, uid, gid, flags, mode FROM files WHERE package = ?", (pkgName,))
-
-        files = cur.fetchall()
+            cur.execute("SELECT COUNT(*) FROM files WHERE package = ?", (pkgName,))
+        rv = cur.fetchone()[0]
         self._closedb()
-        rv = []
-        for f in files:
-            tmp = {}
-            for k in list(f.keys()):
-                tmp[k] = f[k]
-            rv.append(tmp)
         return rv
 
     def FindFile(self, path):
@@ -298,6 +650,7 @@ class PackageDB:
         return rv
 
     def AddFilesBulk(self, list):
+        # The inserts are one transaction either way.
         self._connectdb(isolation_level="DEFERRED")
         cur = self.__conn.cursor()
         stmt = "INSERT OR REPLACE INTO files(package, path, kind, checksum, uid, gid, flags, mode) VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
@@ -327,6 +680,23 @@ class PackageDB:
             self._closedb()
         return
 
+    def RemoveFileEntries(self, paths):
+        # Like RemoveFileEntry(), for a list of paths, done in
+        # batches of REMOVE_BATCH_SIZE.
+        paths = list(paths)
+        if not paths:
+            return
+        self._connectdb()
+        cur = self.__conn.cursor()
+        for start in range(0, len(paths), PackageDB.REMOVE_BATCH_SIZE):
+            batch = paths[start:start + PackageDB.REMOVE_BATCH_SIZE]
+            cur.execute(
+                "DELETE FROM files WHERE path IN ({0})".format(", ".join("?" * len(batch))),
+                batch
+            )
+        self._closedb()
+        return
+
     def RemovePackageFiles(self, pkgName):
         # Remove the files in a package.  This removes them from
         # both the filesystem and database.
@@ -334,21 +704,15 @@ class PackageDB:
             log.warn("Package %s is not in database", pkgName)
             return False
 
-        self._connectdb()
-        cur = self.__conn.cursor()
-
-        cur.execute("SELECT path FROM files WHERE package = ? AND kind <> ?", (pkgName, "dir"))
-        rows = cur.fetchall()
-        file_list = []
-        for row in rows:
-            path = row[0]
-            full_path = self.__db_root + "/" + path
-            if Installer.RemoveFile(full_path) == False:
-                raise Exception("Cannot remove file %s" % path)
-            file_list.append((path, ))
-        cur.executemany("DELETE FROM files WHERE path = ?", file_list)
-        cur.execute("VACUUM")
-        self._closedb()
+        for batch in self.IterFileBatches(pkgName, exclude_kind="dir"):
+            file_list = []
+            for entry in batch:
+                full_path = self.__db_root + "/" + entry.path
+                if Installer.RemoveFile(full_path) == False:
+                    raise Exception("Cannot remove file %s" % entry.path)
+                file_list.append(entry.path)
+            self.RemoveFileEntries(file_list)
+        self._vacuum()
         return True
 
     def RemovePackageDirectories(self, pkgName, failDirectoryRemoval=False):
@@ -361,23 +725,17 @@ class PackageDB:
             log.warn("Package %s is not in database", pkgName)
             return False
 
-        self._connectdb()
-        cur = self.__conn.cursor()
-
-        dir_list = []
-        # Sort the list of directories in descending order, so that
+        # Go through the directories in descending order, so that
         # child directories get removed before their parents.
-        cur.execute("SELECT path FROM files WHERE package = ? AND kind = ? ORDER BY path DESC", (pkgName, "dir"))
-        rows = cur.fetchall()
-        for row in rows:
-            path = row[0]
-            full_path = self.__db_root + "/" + path
-            if Installer.RemoveDirectory(full_path) is False and failDirectoryRemoval is True:
-                raise Exception("Cannot remove directory %s" % path)
-            dir_list.append((path, ))
-        cur.executemany("DELETE FROM files WHERE path = ?", dir_list)
-        cur.execute("VACUUM")
-        self._closedb()
+        for batch in self.IterFileBatches(pkgName, kind="dir", reverse=True):
+            dir_list = []
+            for entry in batch:
+                full_path = self.__db_root + "/" + entry.path
+                if Installer.RemoveDirectory(full_path) is False and failDirectoryRemoval is True:
+                    raise Exception("Cannot remove directory %s" % entry.path)
+                dir_list.append(entry.path)
+            self.RemoveFileEntries(dir_list)
+        self._vacuum()
         return True
 
     def RemovePackageScripts(self, pkgName):
@@ -413,12 +771,12 @@ class PackageDB:
     # That makes it the opposite of RemovePackageContents().
     def RemovePackage(self, pkgName):
         if self.FindPackage(pkgName) is not None:
-            flist = self.FindFilesForPackage(pkgName)
-            if len(flist) != 0:
+            nfiles = self.CountFiles(pkgName)
+            if nfiles != 0:
                 log.error(
                     "Can't remove package %s, it has %d files still",
                     pkgName,
-                    len(flist),
+                    nfiles,
                 )
                 raise Exception("Cannot remove package %s if it still has files" % pkgName)
             dlist = self.FindScriptForPackage(pkgName)
@@ -438,7 +796,7 @@ class PackageDB:
 
 class UpdateServer(object):
 
-    def __init__(self, name=None, url=None, master=None, signing=True):
+    def __init__(self, name=None, url=None, master=None, signing=True, mirrors=None):
         if name is None:
             raise ValueError("Cannot initialize UpdateServer with no name")
         else:
@@ -450,19 +808,24 @@ class UpdateServer(object):
         if master == url:
             self._master = None
         self._signature_required = signing
+        # Mirrors have the same layout as url, and are used
+        # along with it; the master is only tried after them.
+        self._mirrors = list(mirrors) if mirrors else []
 
     def __repr__(self):
-        return "UpdateServer(name={}, url={}, master={}, signing={})".format(
-            self.name, self.url, self.master, self.signature_required)
+        return "UpdateServer(name={}, url={}, master={}, signing={}, mirrors={})".format(
+            self.name, self.url, self.master, self.signature_required, self.mirrors)
 
     def __str__(self):
-        return "<UpdateServe name={} url={} master={} signing={}>".format(
-            self.name, self.url, self._master, self.signature_required)
+        return "<UpdateServe name={} url={} master={} signing={} mirrors={}>".format(
+            self.name, self.url, self._master, self.signature_required, self.mirrors)
     
     def __dict__(self):
         retval = { "name" : self.name, "url" : self.url, "signing" : self.signature_required }
         if self._master and self._master != self.url:
             retval["master"] = self.master
+        if self._mirrors:
+            retval["mirrors"] = ", ".join(self._mirrors)
         return retval
     
     @property
@@ -500,6 +863,451 @@ class UpdateServer(object):
     def signature_required(self, sr):
         self._signature_required = sr
 
+    @property
+    def mirrors(self):
+        return list(self._mirrors)
+
+    @mirrors.setter
+    def mirrors(self, mirrors):
+        self._mirrors = list(mirrors) if mirrors else []
+
+class MirrorStats(object):
+    """
+    Running statistics for one server (scheme://host:port),
+    used to rank mirrors.
+    """
+    def __init__(self, server):
+        self._server = server
+        self._lock = threading.Lock()
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+
+    def __repr__(self):
+        return "MirrorStats(server={}, latency={}, throughput={}, failures={})".format(
+            self._server, self.latency, self.throughput, self.failures)
+
+    @property
+    def server(self):
+        return self._server
+
+    def Record(self, latency=None, nbytes=0, seconds=0):
+        # Record a response's latency, or a transfer's size and
+        # duration.  Either one means the server is working.
+        def ewma(old, new):
+            if old is None:
+                return new
+            return (MIRROR_EWMA_WEIGHT * new) + ((1 - MIRROR_EWMA_WEIGHT) * old)
+
+        with self._lock:
+            if latency is not None:
+                self.latency = ewma(self.latency, latency)
+            # Very small transfers say more about latency than throughput.
+            if nbytes >= 64 * 1024 and seconds > 0:
+                self.throughput = ewma(self.throughput, nbytes / seconds)
+            self.failures = 0
+        return
+
+    def Failed(self):
+        with self._lock:
+            self.failures += 1
+        return
+
+    def Cost(self, size=MIRROR_SCORE_SIZE):
+        # Expected number of seconds to fetch size bytes.
+        with self._lock:
+            rv = self.failures * MIRROR_FAILURE_PENALTY
+            if self.latency is not None:
+                rv += self.latency
+            if self.throughput:
+                rv += size / self.throughput
+        return rv
+
+class TransferStats(object):
+    """
+    Measurements for one network transfer (or, via Add(), a
+    collection of them):  bytes received, wall-clock time, time
+    to first byte, failed attempts, offsets resumed from, and a
+    smoothed rate.  Time is also split into time spent waiting
+    on the network, writing, hashing, and waiting on the rate
+    limiter, to show where the bottleneck is.
+    """
+    # The smoothed rate is updated at most this often, so short
+    # reads don't make it jump around.
+    RATE_INTERVAL = 0.5
+
+    def __init__(self, name=None):
+        self._lock = threading.Lock()
+        self.name = name
+        self.url = None
+        self.size = None
+        self.transfers = 0
+        self.bytes = 0
+        self.started = None
+        self.wall_time = 0.0
+        self.ttfb = None
+        self.retries = 0
+        self.resume_offsets = []
+        self.network_time = 0.0
+        self.write_time = 0.0
+        self.hash_time = 0.0
+        self.wait_time = 0.0
+        self.error = None
+        self._rate = None
+        self._rate_time = None
+        self._rate_bytes = 0
+
+    def __repr__(self):
+        return "TransferStats(name={}, bytes={}, wall_time={:.3f}, rate={})".format(
+            self.name, self.bytes, self.wall_time, self.Rate())
+
+    def Start(self):
+        with self._lock:
+            self.started = time.time()
+            self._rate_time = self.started
+            self.transfers = 1
+        return
+
+    def Finish(self, url=None, size=None, error=None):
+        with self._lock:
+            if self.started is not None:
+                self.wall_time = time.time() - self.started
+            if url:
+                self.url = url
+            if size:
+                self.size = size
+            if error is not None:
+                self.error = str(error)
+        return
+
+    def Retry(self):
+        with self._lock:
+            self.retries += 1
+        return
+
+    def Resume(self, offset):
+        with self._lock:
+            self.resume_offsets.append(offset)
+        return
+
+    def Received(self, nbytes, seconds):
+        # nbytes were read from the network, taking seconds.
+        with self._lock:
+            now = time.time()
+            if self.ttfb is None and nbytes and self.started is not None:
+                self.ttfb = now - self.started
+            self.bytes += nbytes
+            self.network_time += seconds
+            self._rate_bytes += nbytes
+            if self._rate_time is None:
+                self._rate_time = now
+            elif now - self._rate_time >= self.RATE_INTERVAL:
+                rate = self._rate_bytes / (now - self._rate_time)
+                if self._rate is None:
+                    self._rate = rate
+                else:
+                    self._rate = (MIRROR_EWMA_WEIGHT * rate) + ((1 - MIRROR_EWMA_WEIGHT) * self._rate)
+                self._rate_time = now
+                self._rate_bytes = 0
+        return
+
+    def Wrote(self, seconds):
+        with self._lock:
+            self.write_time += seconds
+        return
+
+    def Hashed(self, seconds):
+        with self._lock:
+            self.hash_time += seconds
+        return
+
+    def Waited(self, seconds):
+        with self._lock:
+            self.wait_time += seconds
+        return
+
+    def Rate(self):
+        # Smoothed bytes/second.  Until there's been a full interval,
+        # this is the average so far.
+        with self._lock:
+            if self._rate is not None:
+                return int(self._rate)
+            if self.started is not None and self.network_time > 0:
+                elapsed = time.time() - self.started
+                if elapsed > 0:
+                    return int(self.bytes / elapsed)
+            return 0
+
+    def Add(self, other):
+        # Fold another TransferStats into this one.
+        with self._lock:
+            self.transfers += other.transfers
+            self.bytes += other.bytes
+            self.wall_time += other.wall_time
+            self.retries += other.retries
+            self.network_time += other.network_time
+            self.write_time += other.write_time
+            self.hash_time += other.hash_time
+            self.wait_time += other.wait_time
+            if other.ttfb is not None:
+                self.ttfb = (self.ttfb or 0.0) + other.ttfb
+        return
+
+    def Bottleneck(self):
+        # Whichever of network, disk (writes), cpu (hashing), or
+        # the rate limiter took the most time.
+        times = {
+            "network" : self.network_time,
+            "disk" : self.write_time,
+            "cpu" : self.hash_time,
+            "limit" : self.wait_time,
+        }
+        return max(times, key=times.get) if any(times.values()) else None
+
+    def dict(self):
+        rv = {
+            "name" : self.name,
+            "url" : self.url,
+            "size" : self.size,
+            "bytes" : self.bytes,
+            "wall_time" : round(self.wall_time, 3),
+            "ttfb" : round(self.ttfb, 3) if self.ttfb is not None else None,
+            "retries" : self.retries,
+            "resume_offsets" : list(self.resume_offsets),
+            "rate" : self.Rate(),
+            "network_time" : round(self.network_time, 3),
+            "write_time" : round(self.write_time, 3),
+            "hash_time" : round(self.hash_time, 3),
+            "wait_time" : round(self.wait_time, 3),
+            "bottleneck" : self.Bottleneck(),
+        }
+        if self.error:
+            rv["error"] = self.error
+        return rv
+
+def ParseSize(size):
+    # Convert a size such as "500K" or "2G" (the suffixes
+    # are powers of 1024) to a number of bytes.
+    units = { "K" : 1024, "M" : 1024 * 1024, "G" : 1024 * 1024 * 1024 }
+    size = str(size).strip().upper()
+    multiplier = 1
+    if size and size[-1] in units:
+        multiplier = units[size[-1]]
+        size = size[:-1]
+    rv = int(float(size) * multiplier)
+    if rv < 0:
+        raise ValueError("Size cannot be negative")
+    return rv
+
+def ParseBandwidthLimit(limit):
+    # Convert a rate such as "500K" or "2M" (bytes per second)
+    # to a number.  0 means unlimited.
+    return ParseSize(limit)
+
+def ParseBandwidthSchedule(schedule):
+    # Convert "HH:MM-HH:MM[,HH:MM-HH:MM...]" to a list of
+    # (start, end) pairs, in minutes after midnight.
+    rv = []
+    for window in str(schedule).replace(" ", "").split(","):
+        if not window:
+            continue
+        m = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', window)
+        if m is None:
+            raise ValueError("Invalid bandwidth schedule %s" % window)
+        (sh, sm, eh, em) = [int(x) for x in m.groups()]
+        if sh > 24 or eh > 24 or sm > 59 or em > 59:
+            raise ValueError("Invalid bandwidth schedule %s" % window)
+        rv.append((sh * 60 + sm, eh * 60 + em))
+    return rv
+
+class RateLimiter(object):
+    """
+    A token bucket shared by all network transfers, so their
+    combined rate stays under the limit (in bytes per second;
+    0 means no limit).  If there is a schedule (see
+    ParseBandwidthSchedule), the limit only applies during it;
+    a window that ends before it starts wraps past midnight.
+    """
+    def __init__(self, rate=0, schedule=None):
+        self._lock = threading.Lock()
+        self.SetLimit(rate, schedule)
+
+    def SetLimit(self, rate, schedule=None):
+        with self._lock:
+            self._rate = rate or 0
+            self._schedule = list(schedule) if schedule else []
+            # Allow up to a second's worth of burst.
+            self._tokens = self._rate
+            self._last = time.time()
+        return
+
+    def Rate(self):
+        # The limit in effect right now, or 0 if there isn't one.
+        if not self._rate:
+            return 0
+        if not self._schedule:
+            return self._rate
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for (start, end) in self._schedule:
+            if start <= end:
+                if start <= minute < end:
+                    return self._rate
+            elif minute >= start or minute < end:
+                return self._rate
+        return 0
+
+    def Consume(self, nbytes, cancel=None):
+        # Account for nbytes transferred, waiting as long as
+        # needed to stay under the limit.  Returns early if
+        # cancel (a threading.Event) is set.
+        rate = self.Rate()
+        if not rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+        if wait > 0:
+            if cancel is not None:
+                cancel.wait(wait)
+            else:
+                time.sleep(wait)
+        return
+
+class DownloadCheckpoint(object):
+    """
+    Block digests for a partial download into pathname, so a resumed
+    download only keeps the bytes that were written correctly.
+    Update() is called with the data as it's written; the checkpoint
+    is saved after every block, and by Save() when the transfer stops.
+    hashlib objects can't be saved, so Verify() still reads the kept
+    prefix again, to check it and to rebuild the checksum hash.
+    """
+    def __init__(self, pathname, checksum=None, block_size=CHECKPOINT_BLOCK_SIZE):
+        self._path = pathname + CHECKPOINT_SUFFIX
+        self._checksum = checksum
+        self._block_size = block_size
+        self._blocks = []
+        self._tail = hashlib.sha256()
+        self._tail_length = 0
+
+    def Length(self):
+        # How many bytes the checkpoint covers.
+        return len(self._blocks) * self._block_size + self._tail_length
+
+    def Reset(self):
+        self._blocks = []
+        self._tail = hashlib.sha256()
+        self._tail_length = 0
+        return
+
+    def Update(self, data):
+        view = memoryview(data)
+        while len(view):
+            count = min(len(view), self._block_size - self._tail_length)
+            self._tail.update(view[:count])
+            self._tail_length += count
+            view = view[count:]
+            if self._tail_length == self._block_size:
+                self._blocks.append(self._tail.hexdigest())
+                self._tail = hashlib.sha256()
+                self._tail_length = 0
+                self.Save()
+        return
+
+    def Save(self):
+        import json
+        state = {
+            "checksum" : self._checksum,
+            "block_size" : self._block_size,
+            "blocks" : self._blocks,
+            "tail_length" : self._tail_length,
+            "tail" : self._tail.hexdigest(),
+        }
+        tmp_path = "%s.%d" % (self._path, threading.get_ident())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self._path)
+        except OSError as e:
+            log.debug("Unable to save download checkpoint %s: %s" % (self._path, str(e)))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return
+
+    def Remove(self):
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+        return
+
+    def Verify(self, fobj, hash=None):
+        """
+        Check the partial file fobj against the saved checkpoint,
+        and truncate it after the last block (or tail) that matches;
+        anything past what the checkpoint covers is dropped, since
+        it can't be checked.  If hash is given, it's updated with the
+        bytes kept.  Returns the number of bytes kept; with an unusable
+        checkpoint, that's 0.  With no checkpoint at all, the file is
+        either complete (the checkpoint is removed when a download
+        finishes) or from before checkpoints, so all of it is kept;
+        the final checksum decides whether it's any good.
+        """
+        import json
+        if not os.path.exists(self._path):
+            self.Reset()
+            fobj.seek(0)
+            for data in iter(lambda: fobj.read(self._block_size), b''):
+                self.Update(data)
+                if hash:
+                    hash.update(data)
+            return self.Length()
+        try:
+            with open(self._path, "r") as f:
+                state = json.load(f)
+            if state.get("checksum") != self._checksum:
+                raise ValueError("Different file")
+            if state["block_size"] != self._block_size:
+                raise ValueError("Different block size")
+            saved_blocks = list(state["blocks"])
+            saved_tail = (int(state["tail_length"]), state["tail"])
+        except (OSError, ValueError, KeyError, TypeError):
+            saved_blocks = []
+            saved_tail = (0, None)
+
+        self.Reset()
+        fobj.seek(0)
+        for digest in saved_blocks:
+            data = fobj.read(self._block_size)
+            if len(data) != self._block_size or hashlib.sha256(data).hexdigest() != digest:
+                log.error("%s:  block %d does not match its checkpoint" % (self._path, len(self._blocks)))
+                saved_tail = (0, None)
+                break
+            self._blocks.append(digest)
+            if hash:
+                hash.update(data)
+        (tail_length, tail_digest) = saved_tail
+        if 0 < tail_length < self._block_size:
+            data = fobj.read(tail_length)
+            if len(data) == tail_length and hashlib.sha256(data).hexdigest() == tail_digest:
+                self._tail.update(data)
+                self._tail_length = tail_length
+                if hash:
+                    hash.update(data)
+        length = self.Length()
+        fobj.seek(0, os.SEEK_END)
+        if fobj.tell() != length:
+            log.debug("%s:  truncating partial download from %d to %d bytes" % (self._path, fobj.tell(), length))
+            fobj.truncate(length)
+        fobj.seek(length)
+        return length
+
 default_update_server = UpdateServer(name="default",
                                      url=UPDATE_SERVER,
                                      master=MASTER_UPDATE_SERVER,
@@ -514,8 +1322,25 @@ class Configuration(object):
     _package_dir = None
 
     _manifest = None
+    _trains = None
+    _session = None
+    _session_headers = None
 
     def __init__(self, root=None, file=None):
+        self._session_lock = threading.RLock()
+        self._manifest_cache = {}
+        self._mirror_stats = {}
+        self._bandwidth_limit = None
+        self._bandwidth_schedule = None
+        self._rate_limiter = RateLimiter()
+        self._transfer_stats = collections.deque(maxlen=TRANSFER_STATS_LIMIT)
+        self._package_store = None
+        self._package_store_size = None
+        self._plan_stats = {
+            "packages" : 0, "full" : 0, "delta" : 0,
+            "local" : 0, "store" : 0, "network" : 0,
+            "network_bytes" : 0, "bytes_saved" : 0,
+        }
         if root is not None:
             self._root = root
         if file is not None:
@@ -543,6 +1368,118 @@ class Configuration(object):
         self.UpdateCache()
         return self._update_servers[self._update_server_name].signature_required
 
+    def UpdateServerMirrors(self):
+        self.UpdateCache()
+        return self._update_servers[self._update_server_name].mirrors
+
+    def MirrorStatistics(self, url):
+        # Returns the MirrorStats object for url's server.
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        server = "%s://%s" % (parts.scheme, parts.netloc)
+        with self._session_lock:
+            if server not in self._mirror_stats:
+                self._mirror_stats[server] = MirrorStats(server)
+            return self._mirror_stats[server]
+
+    def RankMirrors(self, urls):
+        # Sort urls, best first, by their servers' statistics.
+        # The sort is stable, so ties keep the given order.
+        return sorted(urls, key=lambda u: self.MirrorStatistics(u).Cost())
+
+    def NetworkRateLimiter(self):
+        # The RateLimiter shared by all transfers.
+        return self._rate_limiter
+
+    def BandwidthLimit(self):
+        # Returns the (limit, schedule) strings, either of which may be None.
+        return (self._bandwidth_limit, self._bandwidth_schedule)
+
+    def SetBandwidthLimit(self, limit=None, schedule=None, save=True):
+        # Limit the combined download rate; limit is a rate for
+        # ParseBandwidthLimit, and schedule is for ParseBandwidthSchedule.
+        # None leaves that setting as it is.  Raises ValueError
+        # for an invalid limit or schedule.
+        if limit is None:
+            limit = self._bandwidth_limit
+        if schedule is None:
+            schedule = self._bandwidth_schedule
+        rate = ParseBandwidthLimit(limit) if limit else 0
+        windows = ParseBandwidthSchedule(schedule) if schedule else None
+        self._bandwidth_limit = str(limit) if limit else None
+        self._bandwidth_schedule = schedule if schedule else None
+        self._rate_limiter.SetLimit(rate, windows)
+        if save:
+            self.StoreUpdateConfigurationFile(self._config_path)
+        return
+
+    def PackageStore(self):
+        # Returns the PackageStore shared by all update directories,
+        # or None if it's disabled (a size of 0) or can't be created.
+        with self._session_lock:
+            if self._package_store is None:
+                size = PackageStore.DEFAULT_STORE_SIZE
+                if self._package_store_size is not None:
+                    size = ParseSize(self._package_store_size)
+                if size == 0 or not self._temp:
+                    return None
+                try:
+                    self._package_store = PackageStore.PackageStore(
+                        os.path.join(self._temp, PackageStore.STORE_DIR), size)
+                except OSError as e:
+                    log.debug("Unable to create package store: %s" % str(e))
+                    return None
+            return self._package_store
+
+    def SetPackageStoreSize(self, size, save=True):
+        # Set the most the package store may hold (see ParseSize);
+        # 0 disables it.  Raises ValueError for an invalid size.
+        ParseSize(size)
+        with self._session_lock:
+            self._package_store_size = str(size)
+            self._package_store = None
+        if save:
+            self.StoreUpdateConfigurationFile(self._config_path)
+        return
+
+    def TransferStatistics(self):
+        # The TransferStats for the network transfers so far
+        # (at most the last TRANSFER_STATS_LIMIT of them).
+        with self._session_lock:
+            return list(self._transfer_stats)
+
+    def TransferSummary(self):
+        # A dictionary (suitable for JSON) with the totals for
+        # all transfers so far, and the individual transfers.
+        total = TransferStats(name="total")
+        transfers = self.TransferStatistics()
+        for stats in transfers:
+            total.Add(stats)
+        rv = total.dict()
+        for key in ("name", "url", "size", "resume_offsets"):
+            rv.pop(key, None)
+        rv["transfers"] = total.transfers
+        if total.transfers and total.ttfb is not None:
+            rv["ttfb"] = round(total.ttfb / total.transfers, 3)
+        # Transfers can overlap, so the overall rate is over the time from
+        # the first start to the last finish; network_rate is how fast the
+        # data came in while we were actually waiting for it.
+        started = [stats.started for stats in transfers if stats.started is not None]
+        if started:
+            elapsed = max(stats.started + stats.wall_time for stats in transfers
+                          if stats.started is not None) - min(started)
+            rv["rate"] = int(total.bytes / elapsed) if elapsed > 0 else 0
+        rv["network_rate"] = int(total.bytes / total.network_time) if total.network_time > 0 else 0
+        rv["files"] = [stats.dict() for stats in transfers]
+        rv["packages"] = self.PackagePlanStatistics()
+        return rv
+
+    def ResetTransferStatistics(self):
+        with self._session_lock:
+            self._transfer_stats.clear()
+        return
+
     def ListUpdateServers(self):
         self.UpdateCache()
         return list(self._update_servers.keys())
@@ -577,18 +1514,113 @@ class Configuration(object):
         if save:
             self.StoreUpdateConfigurationFile(self._config_path)
         
+    def NetworkSession(self):
+        """
+        Return the requests session used for network transfers.
+        It is created on first use, and keeps connections to the
+        update server (and master) alive between requests, so each
+        file doesn't pay for a new TCP and TLS handshake.
+        """
+        import requests
+        import requests.adapters
+
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=NETWORK_POOL_HOSTS,
+                                                        pool_maxsize=NETWORK_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def CloseNetworkSession(self):
+        """
+        Close any pooled connections, and forget the cached request
+        headers; both will be recreated on the next network request.
+        """
+        with self._session_lock:
+            if self._session:
+                self._session.close()
+            self._session = None
+            self._session_headers = None
+
+    def NetworkHeaders(self):
+        """
+        Return a dictionary of the headers sent with each network request
+        (the caller may modify it).  These identify the system -- version,
+        train, host ID, and license -- so they are only computed once per
+        session.
+        """
+        with self._session_lock:
+            if self._session_headers is None:
+                AVATAR_VERSION = "X-%s-Manifest-Version" % Avatar()
+                current_sequence = "unknown"
+                current_train = None
+                current_version = None
+                temp_mani = self.SystemManifest()
+                if temp_mani:
+                    current_sequence = temp_mani.Sequence()
+                    current_version = temp_mani.Version()
+                    current_train = temp_mani.Train()
+                try:
+                    from bsd.sysctl import sysctlbyname
+                    host_id = sysctlbyname("kern.hostuuid").strip('\x00')
+                except:
+                    host_id = None
+
+                license_data = None
+                try:
+                    from freenasUI.support.utils import LICENSE_FILE
+                    with open(LICENSE_FILE, "r") as f:
+                        license_data = f.read().rstrip()
+                        # Make sure license data is a valid header (and base64 string)
+                        # See #21179
+                        if not re.search(r'^[a-z0-9\+\/]+[=]*$', license_data, re.I):
+                            license_data = None
+                except:
+                    pass
+
+                headers = {
+                    "X-iXSystems-Project" : Avatar(),
+                    "X-iXSystems-Version" : current_sequence,
+                    "User-Agent" : "%s=%s" % (AVATAR_VERSION, current_version)
+                }
+                if current_version:
+                    headers["X-iXSystems-Version-Name"] = current_version
+                if current_train:
+                    headers["X-iXSystems-Train"] = current_train
+                if host_id:
+                    headers["X-iXSystems-HostID"] = host_id
+                if license_data:
+                    headers["X-iXSystems-License"] = license_data
+                self._session_headers = headers
+            return self._session_headers.copy()
+
     def TryGetNetworkFile(self, file=None, url=None, handler=None,
                           pathname=None, reason=None, intr_ok=False,
-                          ignore_space=False):
+                          ignore_space=False, cancel=None, checksum=None,
+                          cache=False, stats=None, sequential=False):
+        # If cancel is set, it should be a threading.Event; the
+        # transfer is abandoned (with UpdateDownloadCancelledException)
+        # once it is set.
+        # If checksum is set, it is the expected SHA256 of the file; the
+        # hash is computed as the data arrives, and ChecksumFailException
+        # is raised (and pathname removed) if it doesn't match.
+        # If cache is set (only valid with url), the body is kept in
+        # the network cache, and later requests are conditional; a 304
+        # returns the cached copy.
+        # If stats is a TransferStats object, it's filled in; either way,
+        # the returned file has the stats as its transfer_stats attribute,
+        # and they're added to TransferStatistics().
+        # With intr_ok and pathname, a DownloadCheckpoint is kept next to
+        # the partial file, and a resumed download only keeps the part
+        # of it that matches.
+        # If sequential is set, pathname is always written in order
+        # (never in segments), so it can be read while it grows.
         # Lazy import requests to not require it on install
         import requests
-        import urllib3.exceptions
 
-        AVATAR_VERSION = "X-%s-Manifest-Version" % Avatar()
-        current_sequence = "unknown"
-        current_train = None
-        current_version = None
-        host_id = None
         if file and url:
             log.debug("Cannot specify both file and url for TryGetNetworkFile")
             raise Exception("Bad use of TryGetNetworkFile")
@@ -597,47 +1629,88 @@ class Configuration(object):
             raise Exception("Bad use of TryGetNetworkFile again")
 
         if file:
-            # If we're looking for a file in general, look in the update server and the master.
-            file_url = ["%s/%s" % (self.UpdateServerURL(), file)]
+            # If we're looking for a file in general, look in the update server
+            # and its mirrors (best first), and then the master.
+            servers = [self.UpdateServerURL()]
+            for mirror in self.UpdateServerMirrors():
+                if mirror not in servers and mirror != self.UpdateServerMaster():
+                    servers.append(mirror)
+            file_url = self.RankMirrors(["%s/%s" % (server, file) for server in servers])
             if self.UpdateServerURL() != self.UpdateServerMaster():
                 file_url.append("%s/%s" % (self.UpdateServerMaster(), file))
         elif url:
             file_url = [url]
         log.debug("TryGetNetworkFile(%s)" % file_url)
-        temp_mani = self.SystemManifest()
-        if temp_mani:
-            current_sequence = temp_mani.Sequence()
-            current_version = temp_mani.Version()
-            current_train = temp_mani.Train()
-        try:
-            from bsd.sysctl import sysctlbyname
-            host_id = sysctlbyname("kern.hostuuid").strip('\x00')
-        except:
-            host_id = None
+        session = self.NetworkSession()
+        limiter = self.NetworkRateLimiter()
+        if stats is None:
+            stats = TransferStats(name=file if file else url)
+        with self._session_lock:
+            self._transfer_stats.append(stats)
+
+        cache_path = None
+        if cache:
+            if file or pathname:
+                log.debug("Cannot use the network cache with file or pathname")
+                raise Exception("Bad use of TryGetNetworkFile")
+            cache_path = self.NetworkCachePath(url)
+            if cache_path:
+                # Download next to the entry, and rename it into place
+                # once it's complete.  These are small files, which
+                # didn't get a space check before either.
+                pathname = "%s.%d.part" % (cache_path, threading.get_ident())
+                intr_ok = False
+                ignore_space = True
+
+        # A segmented download in progress is resumed as one.
+        segment_state = None
+        if pathname and not cache_path and not sequential:
+            if intr_ok:
+                segment_state = self.LoadSegmentState(pathname, checksum)
+            if segment_state is None and os.path.exists(pathname + SEGMENT_STATE_SUFFIX):
+                os.unlink(pathname + SEGMENT_STATE_SUFFIX)
+                if intr_ok and os.path.exists(pathname):
+                    # The partial file isn't contiguous, so can't be resumed.
+                    os.unlink(pathname)
 
-        license_data = None
-        try:
-            from freenasUI.support.utils import LICENSE_FILE
-            with open(LICENSE_FILE, "r") as f:
-                license_data = f.read().rstrip()
-                # Make sure license data is a valid header (and base64 string)
-                # See #21179
-                if not re.search(r'^[a-z0-9\+\/]+[=]*$', license_data, re.I):
-                    license_data = None
-        except:
-            pass
+        checkpoint = None
+        if pathname and intr_ok and not cache_path:
+            checkpoint = DownloadCheckpoint(pathname, checksum)
+            if segment_state:
+                checkpoint.Remove()
+                checkpoint = None
+
+        if pathname and not cache_path:
+            # It may be hard-linked to a package store entry, which
+            # mustn't be written to.
+            PackageStore.Unshare(pathname)
 
         read = 0
         retval = None
+        failure = None
+        stats.Start()
         try:
+            if segment_state:
+                retval = open(pathname, "r+b")
+                return self.SegmentedGetNetworkFile(file_url, retval, segment_state,
+                                                    handler=handler, reason=reason,
+                                                    intr_ok=intr_ok,
+                                                    ignore_space=ignore_space,
+                                                    cancel=cancel, checksum=checksum,
+                                                    stats=stats)
+            hash = None
+            if checksum:
+                hash = hashlib.sha256()
             if pathname:
                 if intr_ok:
                     try:
                         retval = open(pathname, "r+b")
-                        read = os.fstat(retval.fileno()).st_size
-                        retval.seek(read)
                     except:
                         pass
+                    else:
+                        # Resuming, so keep what matches the checkpoint;
+                        # the hash has to include it.
+                        read = checkpoint.Verify(retval, hash)
                 if retval is None:
                     retval = open(pathname, "w+b")
             else:
@@ -646,39 +1719,66 @@ class Configuration(object):
             if read > 0:
                 log.debug("File already exists, using a starting size of %d" % read)
 
+            def VerifyChecksum():
+                if hash is None or hash.hexdigest() == checksum:
+                    return
+                log.error("TryGetNetworkFile(%s):  checksum does not match" % file_url)
+                if pathname:
+                    # A resumed download can't be fixed, so start over next time.
+                    try:
+                        os.unlink(pathname)
+                    except OSError:
+                        pass
+                    if checkpoint:
+                        checkpoint.Remove()
+                raise Exceptions.ChecksumFailException("%s has invalid checksum" % (file if file else url))
+
+            # Try each server in turn.  If one fails part way through
+            # the file, the next one picks up where it left off.
             furl = None
+            url_exc = None
             for url in file_url:
+                if cancel is not None and cancel.is_set():
+                    raise Exceptions.UpdateDownloadCancelledException("Download of %s cancelled" % file_url)
+                if url_exc:
+                    log.debug("TryGetNetworkFile:  trying %s at offset %d" % (url, read))
+                    stats.Retry()
+                furl = None
                 url_exc = None
+                started = time.time()
                 try:
-                    header_dict = {
-                        "X-iXSystems-Project" : Avatar(),
-                        "X-iXSystems-Version" : current_sequence,
-                        "User-Agent" : "%s=%s" % (AVATAR_VERSION, current_version)
-                    }
-                    if current_version:
-                        header_dict["X-iXSystems-Version-Name"] = current_version
-                    if current_train:
-                        header_dict["X-iXSystems-Train"] = current_train
-                    if host_id:
-                        header_dict["X-iXSystems-HostID"] = host_id
+                    header_dict = self.NetworkHeaders()
                     if reason:
                         header_dict["X-iXSystems-Reason"] = reason
-                    if license_data:
-                        header_dict["X-iXSystems-License"] = license_data
 
                     # Allow restarting
-                    if intr_ok:
+                    if intr_ok or read > 0:
                         header_dict["Range"] = "bytes=%d-" % read
+                        if read > 0:
+                            stats.Resume(read)
 
-                    furl = requests.get(url, timeout=10, verify=DEFAULT_CA_FILE,
+                    if cache_path and os.path.exists(cache_path):
+                        cache_info = self.NetworkCacheInfo(url)
+                        if cache_info.get("ETag"):
+                            header_dict["If-None-Match"] = cache_info["ETag"]
+                        if cache_info.get("Last-Modified"):
+                            header_dict["If-Modified-Since"] = cache_info["Last-Modified"]
+
+                    furl = session.get(url, timeout=NETWORK_TIMEOUT, verify=DEFAULT_CA_FILE,
                                        stream=True, headers=header_dict)
                     furl.raise_for_status()
                 except requests.exceptions.HTTPError as error:
+                    furl.close()
+                    furl = None
                     if error.response.status_code == HTTP_RANGE.value:
                         # We've reached the end of the file already
                         # Can I get this incorrectly from any other server?
                         # Do I need to do something different for the progress handler?
+                        VerifyChecksum()
+                        if checkpoint:
+                            checkpoint.Remove()
                         retval.seek(0)
+                        retval.transfer_stats = stats
                         return retval
                     elif error.response.status_code == HTTP_NOT_FOUND.value:
                         # The requested file is not found on this server.
@@ -687,25 +1787,168 @@ class Configuration(object):
                     else:
                         log.error("Got http error %s" % str(error))
                         url_exc = Exceptions.UpdateNetworkServerException("Unable to load from url %s: %d" % (url, error.response.status_code))
-                        url_exc = error
+                        if error.response.status_code >= 500:
+                            # The server is having trouble; rank it lower.
+                            self.MirrorStatistics(url).Failed()
                 except requests.exceptions.ConnectionError as e:
                     log.error("Unable to connect to url %s: %s" % (url, str(e)))
                     url_exc = Exceptions.UpdateNetworkConnectionException("Unable to connect to url %s" % url)
+                    self.MirrorStatistics(url).Failed()
                 except BaseException as e:
                     log.error("Unable to load %s: %s", url, str(e))
                     url_exc = e
+                    if furl:
+                        furl.close()
+                        furl = None
 
-                if furl:
-                    break
+                if furl is None:
+                    continue
+                self.MirrorStatistics(url).Record(latency=time.time() - started)
+
+                if cache_path and furl.status_code == HTTP_NOT_MODIFIED.value:
+                    log.debug("TryGetNetworkFile(%s):  Not modified, using cached copy" % file_url)
+                    furl.close()
+                    retval.close()
+                    retval = None
+                    os.unlink(pathname)
+                    cached_file = open(cache_path, "rb")
+                    cached_file.transfer_stats = stats
+                    return cached_file
+
+                if read > 0 and furl.status_code != HTTP_PARTIAL_CONTENT.value:
+                    # The server ignored the Range request, and is sending
+                    # the whole file, so start over.
+                    log.debug("TryGetNetworkFile(%s):  Server does not support ranges, restarting" % url)
+                    retval.seek(0)
+                    retval.truncate()
+                    read = 0
+                    if checksum:
+                        hash = hashlib.sha256()
+                    if checkpoint:
+                        checkpoint.Reset()
+
+                try:
+                    totalsize = read + int(furl.headers['Content-Length'].strip())
+                except:
+                    totalsize = None
+
+                if pathname and not cache_path and not sequential and read == 0 and NETWORK_SEGMENTS > 1 \
+                   and totalsize and totalsize >= NETWORK_SEGMENT_THRESHOLD \
+                   and (furl.status_code == HTTP_PARTIAL_CONTENT.value or
+                        furl.headers.get("Accept-Ranges", "").lower() == "bytes"):
+                    # Big enough to be worth fetching in pieces.
+                    furl.close()
+                    if checkpoint:
+                        checkpoint.Remove()
+                    segment_size = (totalsize + NETWORK_SEGMENTS - 1) // NETWORK_SEGMENTS
+                    segment_state = {
+                        "size" : totalsize,
+                        "checksum" : checksum,
+                        "segments" : [[start, min(start + segment_size, totalsize), start]
+                                      for start in range(0, totalsize, segment_size)],
+                    }
+                    return self.SegmentedGetNetworkFile(file_url[file_url.index(url):],
+                                                        retval, segment_state,
+                                                        handler=handler, reason=reason,
+                                                        intr_ok=intr_ok,
+                                                        ignore_space=ignore_space,
+                                                        cancel=cancel, checksum=checksum,
+                                                        stats=stats)
+
+                if totalsize and pathname and ignore_space is False:
+                    space_needed = totalsize - read
+
+                    if CheckFreeSpace(path=pathname, required=space_needed) is False:
+                        # Hm, we don't distinguish between out of space, and zfs performance check
+                        furl.close()
+                        raise Exceptions.UpdateInsufficientSpace("Insufficient space")
+
+                chunk_size = 64 * 1024
+                mbyte = 1024 * 1024
+                lastpercent = percent = 0
+                start_read = read
+                try:
+                    while True:
+                        if cancel is not None and cancel.is_set():
+                            raise Exceptions.UpdateDownloadCancelledException("Download of %s cancelled" % file_url)
+                        read_start = time.time()
+                        try:
+                            data = furl.raw.read(chunk_size)
+                        except Exception as e:
+                            # A stalled or dropped connection; let the
+                            # next server finish the file.
+                            log.error("Transfer from %s failed at offset %d: %s" % (url, read, str(e)))
+                            url_exc = Exceptions.UpdateNetworkConnectionException("Transfer from %s failed" % url)
+                            break
+                        stats.Received(len(data), time.time() - read_start)
+                        if not data:
+                            log.debug("TryGetNetworkFile(%s):  Read %d bytes total" % (file_url, read))
+                            if totalsize and read < totalsize:
+                                log.error("Transfer from %s ended early at offset %d" % (url, read))
+                                url_exc = Exceptions.UpdateNetworkConnectionException("Transfer from %s ended early" % url)
+                            break
+                        read += len(data)
+                        if ((read % mbyte) == 0):
+                            log.debug("TryGetNetworkFile(%s):  Read %d bytes" % (file_url, read))
+
+                        if handler and totalsize:
+                            percent = int((float(read) / float(totalsize)) * 100.0)
+                            if percent != lastpercent:
+                                # Any time spent waiting for the rate limiter is
+                                # already in the rate, but it can't be more than
+                                # the limit itself.
+                                downrate = stats.Rate()
+                                rate_limit = limiter.Rate()
+                                handler(
+                                    'network',
+                                    url,
+                                    size=totalsize,
+                                    progress=percent,
+                                    download_rate=min(downrate, rate_limit) if rate_limit else downrate,
+                                )
+                            lastpercent = percent
+                        if hash:
+                            hash_start = time.time()
+                            hash.update(data)
+                            stats.Hashed(time.time() - hash_start)
+                        write_start = time.time()
+                        retval.write(data)
+                        if checkpoint:
+                            checkpoint.Update(data)
+                        stats.Wrote(time.time() - write_start)
+                        wait_start = time.time()
+                        limiter.Consume(len(data), cancel)
+                        stats.Waited(time.time() - wait_start)
+                except Exception as e:
+                    log.debug("Got exception %s" % str(e), exc_info=True)
+                    if intr_ok is False and pathname:
+                        os.unlink(pathname)
+                    raise e
+                finally:
+                    if checkpoint:
+                        # Everything written so far is covered, so save that.
+                        retval.flush()
+                        checkpoint.Save()
+                    # This hands the connection back to the session's pool
+                    # if the whole response was read.
+                    furl.close()
+
+                if url_exc:
+                    self.MirrorStatistics(url).Failed()
+                    continue
+                self.MirrorStatistics(url).Record(nbytes=read - start_read,
+                                                  seconds=time.time() - started)
+                break
 
             # The loop above should leave url_exc set to None if the file
             # was grabbed.
             if url_exc:
-                if furl:
-                    furl.close()
-                    furl = None
-                if retval:
-                    retval.close()
+                if pathname and not cache_path and (intr_ok is False or read == 0):
+                    # Nothing worth resuming, eg after a 404; don't
+                    # leave an empty file (and checkpoint) behind.
+                    os.unlink(pathname)
+                    if checkpoint:
+                        checkpoint.Remove()
                 log.error("Unable to load %s: %s", file_url, str(url_exc))
                 raise url_exc
 
@@ -716,61 +1959,311 @@ class Configuration(object):
                     retval.close()
                 return None
 
+            VerifyChecksum()
+            if checkpoint:
+                checkpoint.Remove()
+            if cache_path:
+                os.rename(pathname, cache_path)
+                self.SetNetworkCacheInfo(url, {
+                    "URL" : url,
+                    "ETag" : furl.headers.get("ETag"),
+                    "Last-Modified" : furl.headers.get("Last-Modified"),
+                })
+            retval.seek(0)
+            retval.transfer_stats = stats
+        except BaseException as e:
+            failure = e
+            if retval:
+                retval.close()
+            if cache_path and os.path.exists(pathname):
+                os.unlink(pathname)
+            raise
+        finally:
+            stats.Finish(url=url, size=os.fstat(retval.fileno()).st_size if retval and not retval.closed else None,
+                         error=failure)
+        return retval
+
+    def LoadSegmentState(self, pathname, checksum=None):
+        # Returns the saved state of a segmented download into pathname,
+        # or None if there isn't a usable one.
+        import json
+        try:
+            with open(pathname + SEGMENT_STATE_SUFFIX, "r") as f:
+                state = json.load(f)
+            size = state["size"]
+            for (start, end, done) in state["segments"]:
+                if not (0 <= start <= done <= end <= size):
+                    raise ValueError("Bad segment")
+            if state.get("checksum") != checksum:
+                raise ValueError("Different file")
+            if os.path.getsize(pathname) != size:
+                raise ValueError("Wrong size")
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return state
+
+    def SaveSegmentState(self, pathname, state):
+        import json
+        state_path = pathname + SEGMENT_STATE_SUFFIX
+        tmp_path = "%s.%d" % (state_path, threading.get_ident())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.rename(tmp_path, state_path)
+        except OSError as e:
+            log.debug("Unable to save download state %s: %s" % (state_path, str(e)))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return
+
+    def SegmentedGetNetworkFile(self, file_url, retval, state, handler=None,
+                                reason=None, intr_ok=False, ignore_space=False,
+                                cancel=None, checksum=None, stats=None):
+        # Fetch a large file as several byte ranges at once.  retval
+        # is the (open) destination file, and state describes the file
+        # size and the segments, as [start, end, next offset] lists; it
+        # is saved next to the file as it goes, so each segment can pick
+        # up where it left off if the download is interrupted.  Each
+        # segment tries the servers in file_url in order, resuming on the
+        # next one if a transfer fails.
+        # Called from TryGetNetworkFile, and returns the same way.
+        if stats is None:
+            stats = TransferStats(name=file_url[0])
+            stats.Start()
+        from concurrent.futures import ThreadPoolExecutor
+
+        pathname = retval.name
+        size = state["size"]
+        segments = state["segments"]
+        session = self.NetworkSession()
+        limiter = self.NetworkRateLimiter()
+        fd = retval.fileno()
+        lock = threading.Lock()
+        stop = threading.Event()
+        chunk_size = 64 * 1024
+        save_interval = 8 * 1024 * 1024
+        progress = {
+            "read" : sum(done - start for (start, end, done) in segments),
+            "saved" : 0,
+            "percent" : 0,
+        }
+        first_read = progress["read"]
+
+        log.debug("TryGetNetworkFile(%s):  fetching %d bytes in %d segments, %d already read" %
+                  (file_url, size, len(segments), first_read))
+
+        if pathname and ignore_space is False:
+            if CheckFreeSpace(path=pathname, required=size - first_read) is False:
+                raise Exceptions.UpdateInsufficientSpace("Insufficient space")
+
+        if os.fstat(fd).st_size != size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                # Not every filesystem (e.g., ZFS) supports this.
+                os.ftruncate(fd, size)
+            self.SaveSegmentState(pathname, state)
+
+        def Progress(url, count):
+            # Called with lock held
+            progress["read"] += count
+            if intr_ok and progress["read"] - progress["saved"] >= save_interval:
+                self.SaveSegmentState(pathname, state)
+                progress["saved"] = progress["read"]
+            if handler:
+                percent = int((float(progress["read"]) / float(size)) * 100.0)
+                if percent != progress["percent"]:
+                    rate = stats.Rate()
+                    rate_limit = limiter.Rate()
+                    handler(
+                        'network',
+                        url,
+                        size=size,
+                        progress=percent,
+                        download_rate=min(rate, rate_limit) if rate_limit else rate,
+                    )
+                progress["percent"] = percent
+
+        def FetchSegment(segment):
+            url_exc = None
+            for url in file_url:
+                if segment[2] >= segment[1]:
+                    break
+                if url_exc:
+                    stats.Retry()
+                if segment[2] > segment[0]:
+                    stats.Resume(segment[2])
+                url_exc = None
+                seg_started = time.time()
+                seg_read = 0
+                try:
+                    header_dict = self.NetworkHeaders()
+                    if reason:
+                        header_dict["X-iXSystems-Reason"] = reason
+                    header_dict["Range"] = "bytes=%d-%d" % (segment[2], segment[1] - 1)
+                    furl = session.get(url, timeout=NETWORK_TIMEOUT, verify=DEFAULT_CA_FILE,
+                                       stream=True, headers=header_dict)
+                except BaseException as e:
+                    log.error("Unable to load %s: %s", url, str(e))
+                    url_exc = Exceptions.UpdateNetworkConnectionException("Unable to connect to url %s" % url)
+                    self.MirrorStatistics(url).Failed()
+                    continue
+                try:
+                    if furl.status_code != HTTP_PARTIAL_CONTENT.value:
+                        log.error("Range request to %s got status %d" % (url, furl.status_code))
+                        url_exc = Exceptions.UpdateNetworkServerException("Unable to load from url %s: %d" % (url, furl.status_code))
+                        if furl.status_code >= 500:
+                            self.MirrorStatistics(url).Failed()
+                        continue
+                    self.MirrorStatistics(url).Record(latency=time.time() - seg_started)
+                    while segment[2] < segment[1]:
+                        if stop.is_set():
+                            return
+                        if cancel is not None and cancel.is_set():
+                            raise Exceptions.UpdateDownloadCancelledException("Download of %s cancelled" % file_url)
+                        read_start = time.time()
+                        try:
+                            data = furl.raw.read(min(chunk_size, segment[1] - segment[2]))
+                        except Exception as e:
+                            log.error("Transfer from %s failed at offset %d: %s" % (url, segment[2], str(e)))
+                            data = None
+                        if not data:
+                            url_exc = Exceptions.UpdateNetworkConnectionException("Transfer from %s failed" % url)
+                            break
+                        stats.Received(len(data), time.time() - read_start)
+                        write_start = time.time()
+                        os.pwrite(fd, data, segment[2])
+                        stats.Wrote(time.time() - write_start)
+                        seg_read += len(data)
+                        with lock:
+                            segment[2] += len(data)
+                            Progress(url, len(data))
+                        wait_start = time.time()
+                        limiter.Consume(len(data), cancel)
+                        stats.Waited(time.time() - wait_start)
+                finally:
+                    furl.close()
+                if url_exc:
+                    self.MirrorStatistics(url).Failed()
+                    continue
+                self.MirrorStatistics(url).Record(nbytes=seg_read,
+                                                  seconds=time.time() - seg_started)
+                break
+            if url_exc:
+                raise url_exc
+
+        def RunSegment(segment):
             try:
-                totalsize = read + int(furl.headers['Content-Length'].strip())
+                FetchSegment(segment)
             except:
-                totalsize = None
+                # Tell the others to give up, too.
+                stop.set()
+                raise
+
+        failure = None
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(RunSegment, segment) for segment in segments]
+            for future in futures:
+                exc = future.exception()
+                if exc and failure is None:
+                    failure = exc
+
+        if failure is None and cancel is not None and cancel.is_set():
+            failure = Exceptions.UpdateDownloadCancelledException("Download of %s cancelled" % file_url)
+        if failure:
+            if intr_ok:
+                self.SaveSegmentState(pathname, state)
+            else:
+                for path in (pathname, pathname + SEGMENT_STATE_SUFFIX):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+            raise failure
 
-            if totalsize and pathname and ignore_space is False:
-                space_needed = totalsize - read
+        log.debug("TryGetNetworkFile(%s):  Read %d bytes total" % (file_url, size))
+        try:
+            os.unlink(pathname + SEGMENT_STATE_SUFFIX)
+        except OSError:
+            pass
+        # The segments arrive out of order, so the checksum
+        # has to be a separate pass over the finished file.
+        if checksum:
+            hash_start = time.time()
+            file_checksum = ChecksumFile(retval)
+            stats.Hashed(time.time() - hash_start)
+            if file_checksum != checksum:
+                log.error("TryGetNetworkFile(%s):  checksum does not match" % file_url)
+                os.unlink(pathname)
+                raise Exceptions.ChecksumFailException("%s has invalid checksum" % file_url[0])
+        retval.seek(0)
+        retval.transfer_stats = stats
+        return retval
 
-                if CheckFreeSpace(path=pathname, required=space_needed) is False:
-                    # Hm, we don't distinguish between out of space, and zfs performance check
-                    raise Exceptions.UpdateInsufficientSpace("Insufficient space")
+    def NetworkCachePath(self, url):
+        # Returns the path of the network cache entry for url,
+        # creating the cache directory if needed.  Returns None
+        # if there's no usable cache directory.
+        if not self._temp:
+            return None
+        cache_dir = os.path.join(self._temp, NETWORK_CACHE_DIR)
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            st = os.lstat(cache_dir)
+        except OSError as e:
+            log.debug("Unable to create network cache %s: %s" % (cache_dir, str(e)))
+            return None
+        # The temporary directory may be /tmp; don't use a cache
+        # someone else could have put things in.  (Older versions
+        # made it 0755, which is tightened.)
+        if not S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() \
+           or S_IMODE(st.st_mode) & 0o022:
+            log.error("Not using network cache %s:  it must be a directory, owned by us, mode 0700" % cache_dir)
+            return None
+        if S_IMODE(st.st_mode) & 0o077:
+            try:
+                os.chmod(cache_dir, 0o700)
+            except OSError as e:
+                log.debug("Unable to set mode of network cache %s: %s" % (cache_dir, str(e)))
+                return None
+        return os.path.join(cache_dir, hashlib.sha256(url.encode('utf8')).hexdigest())
 
-            chunk_size = 64 * 1024
-            mbyte = 1024 * 1024
-            lastpercent = percent = 0
-            lasttime = time.time()
+    def NetworkCacheInfo(self, url):
+        # Returns the sidecar dictionary for the cache entry for url;
+        # it is empty if there is no entry.
+        import json
+        cache_path = self.NetworkCachePath(url)
+        if cache_path is None:
+            return {}
+        try:
+            with open(cache_path + ".json", "r") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(info, dict) or info.get("URL") != url:
+            return {}
+        return info
+
+    def SetNetworkCacheInfo(self, url, info):
+        # Replaces the sidecar for the cache entry for url.
+        import json
+        cache_path = self.NetworkCachePath(url)
+        if cache_path is None:
+            return
+        tmp_path = "%s.json.%d" % (cache_path, threading.get_ident())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(info, f)
+            os.rename(tmp_path, cache_path + ".json")
+        except OSError as e:
+            log.debug("Unable to update network cache for %s: %s" % (url, str(e)))
             try:
-                while True:
-                    data = furl.raw.read(chunk_size)
-                    tmptime = time.time()
-                    if tmptime - lasttime > 0:
-                        downrate = int(chunk_size / (tmptime - lasttime))
-                    else:
-                        downrate = chunk_size
-                    lasttime = tmptime
-                    if not data:
-                        log.debug("TryGetNetworkFile(%s):  Read %d bytes total" % (file_url, read))
-                        break
-                    read += len(data)
-                    if ((read % mbyte) == 0):
-                        log.debug("TryGetNetworkFile(%s):  Read %d bytes" % (file_url, read))
-
-                    if handler and totalsize:
-                        percent = int((float(read) / float(totalsize)) * 100.0)
-                        if percent != lastpercent:
-                            handler(
-                                'network',
-                                url,
-                                size=totalsize,
-                                progress=percent,
-                                download_rate=downrate,
-                            )
-                        lastpercent = percent
-                    retval.write(data)
-            except Exception as e:
-                log.debug("Got exception %s" % str(e), exc_info=True)
-                if intr_ok is False and pathname:
-                    os.unlink(pathname)
-                raise e
-            retval.seek(0)
-        except:
-            if retval:
-                retval.close()
-            raise
-        return retval
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return
 
     # Load the list of currently-watched trains.
     # The file is a JSON file.
@@ -800,18 +2293,84 @@ class Configuration(object):
             temp = Train.Train(sys_mani.Train(), "Installed OS", sys_mani.Sequence())
             self._trains[temp.Name()] = temp
         if updatecheck:
-            for train in self._trains:
-                new_man = self.FindLatestManifest(train.Name())
-                if new_man:
-                    if new_man.Sequence() != train.LastSequence():
-                        # We have an update
-                        train.SetLastSequence(new_man.Sequence())
-                        train.SetLastCheckedTime()
-                        train.SetNotes(new_man.Notes())
-                        train.SetNotice(new_man.Notice())
-                        train.SetUpdate(True)
+            self.CheckTrains(save=False)
         return
 
+    def CheckTrains(self, trains=None, workers=TRAIN_CHECK_WORKERS, save=True):
+        """
+        Check several trains (by default, all of the watched trains)
+        for updates at once.  The watched Train objects are updated
+        with the results, and, if save is set, the trains file is
+        written once at the end.
+        Returns a dictionary, keyed by train name, of dictionaries:
+        Sequence -- the latest sequence, or None if it couldn't be checked
+        Update -- True if the sequence is not the last one seen
+        Reboot -- True if updating to it would require a reboot
+        Packages -- (name, op, old version) for each package that differs
+        from the installed system
+        Notice -- the manifest's notice, if any
+        Error -- set (to a string) if the check failed
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        watched = self.WatchedTrains()
+        if trains is None:
+            trains = list(watched.keys())
+        sys_mani = self.SystemManifest()
+
+        def check(train_name):
+            result = {
+                "Sequence" : None,
+                "Update" : False,
+                "Reboot" : False,
+                "Packages" : [],
+                "Notice" : None,
+            }
+            try:
+                new_man = self.FindLatestManifest(train=train_name, require_signature=True)
+            except BaseException as e:
+                log.error("Unable to check train %s: %s" % (train_name, str(e)))
+                result["Error"] = str(e)
+                return (result, None)
+            if new_man is None:
+                result["Error"] = "No manifest for train %s" % train_name
+                return (result, None)
+            result["Sequence"] = new_man.Sequence()
+            result["Notice"] = new_man.Notice()
+            diffs = Manifest.DiffManifests(sys_mani, new_man) if sys_mani else {}
+            result["Reboot"] = bool(diffs.get("Reboot", False))
+            for (pkg, op, old) in diffs.get("Packages", []):
+                if op == "delete":
+                    old = pkg
+                result["Packages"].append((pkg.Name(), op, old.Version() if old else None))
+            return (result, new_man)
+
+        rv = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(trains) or 1))) as executor:
+            checks = dict(zip(trains, executor.map(check, trains)))
+
+        # Now update the watched trains, all at once.
+        checked = str(int(time.time()))
+        for train_name in trains:
+            (result, new_man) = checks[train_name]
+            if new_man:
+                train = watched.get(train_name)
+                if train is None:
+                    train = Train.Train(train_name)
+                    watched[train_name] = train
+                train.SetLastCheckedTime(checked)
+                if new_man.Sequence() != train.LastSequence():
+                    # We have an update
+                    train.SetLastSequence(new_man.Sequence())
+                    train.SetNotes(new_man.Notes())
+                    train.SetNotice(new_man.Notice())
+                    train.SetUpdate(True)
+                result["Update"] = train.UpdateAvailable()
+            rv[train_name] = result
+        if save:
+            self.SaveTrainsConfig()
+        return rv
+
     # Save the list of currently-watched trains.
     def SaveTrainsConfig(self):
         import json
@@ -867,6 +2426,13 @@ class Configuration(object):
             # We are using a different one
             cfp.add_section(CONFIG_DEFAULT)
             cfp.set(CONFIG_DEFAULT, CONFIG_SERVER, self._update_server_name)
+        for (key, value) in ((CONFIG_BANDWIDTH_LIMIT, self._bandwidth_limit),
+                             (CONFIG_BANDWIDTH_SCHEDULE, self._bandwidth_schedule),
+                             (CONFIG_PACKAGE_STORE_SIZE, self._package_store_size)):
+            if value:
+                if not cfp.has_section(CONFIG_DEFAULT):
+                    cfp.add_section(CONFIG_DEFAULT)
+                cfp.set(CONFIG_DEFAULT, key, value)
         for name, server in self._update_servers.items():
             if name == default_update_server.name:
                 # We don't write this one out
@@ -916,6 +2482,20 @@ class Configuration(object):
             if section == CONFIG_DEFAULT:
                 if cfp.has_option(CONFIG_DEFAULT, CONFIG_SERVER):
                     self._update_server_name = cfp.get(CONFIG_DEFAULT, CONFIG_SERVER)
+                if cfp.has_option(CONFIG_DEFAULT, CONFIG_BANDWIDTH_LIMIT) or \
+                   cfp.has_option(CONFIG_DEFAULT, CONFIG_BANDWIDTH_SCHEDULE):
+                    try:
+                        self.SetBandwidthLimit(cfp.get(CONFIG_DEFAULT, CONFIG_BANDWIDTH_LIMIT, fallback=None),
+                                               cfp.get(CONFIG_DEFAULT, CONFIG_BANDWIDTH_SCHEDULE, fallback=None),
+                                               save=False)
+                    except ValueError as e:
+                        log.error("Ignoring bandwidth limit: %s" % str(e))
+                if cfp.has_option(CONFIG_DEFAULT, CONFIG_PACKAGE_STORE_SIZE):
+                    try:
+                        self.SetPackageStoreSize(cfp.get(CONFIG_DEFAULT, CONFIG_PACKAGE_STORE_SIZE),
+                                                 save=False)
+                    except ValueError as e:
+                        log.error("Ignoring package store size: %s" % str(e))
             else:
                 if cfp.has_option(section, UPDATE_SERVER_NAME_KEY) and \
                    cfp.has_option(section, UPDATE_SERVER_URL_KEY):
@@ -926,8 +2506,11 @@ class Configuration(object):
                         if cfp.has_option(section, UPDATE_SERVER_SIGNED_KEY) else True
                     m = cfp.get(section, UPDATE_SERVER_MASTER_KEY) \
                         if cfp.has_option(section, UPDATE_SERVER_MASTER_KEY) else None
+                    mirrors = cfp.get(section, UPDATE_SERVER_MIRRORS_KEY).replace(",", " ").split() \
+                        if cfp.has_option(section, UPDATE_SERVER_MIRRORS_KEY) else None
                     try:
-                        update_server = UpdateServer(name=n, url=u, signing=s, master=m)
+                        update_server = UpdateServer(name=n, url=u, signing=s, master=m,
+                                                     mirrors=mirrors)
                         self._update_servers[section] = update_server
                     except:
                         log.error("Cannot set update server to %s, using default", n)
@@ -1006,7 +2589,7 @@ class Configuration(object):
 
     def WatchedTrains(self):
         if self._trains is None:
-            self._trains = self.LoadTrainsConfig()
+            self.LoadTrainsConfig()
         return self._trains
 
     def WatchTrain(self, train, watch=True):
@@ -1081,7 +2664,8 @@ class Configuration(object):
 
         file_ref = self.TryGetNetworkFile(url="%s/%s" % (self.UpdateServerMaster(), ManifestFile),
                                           handler=handler,
-                                          reason="GetManifest")
+                                          reason="GetManifest",
+                                          cache=True)
         return file_ref
 
     def FindLatestManifest(self, train=None, require_signature=False):
@@ -1100,15 +2684,39 @@ class Configuration(object):
             else:
                 train = temp_mani.Train()
 
-        mani_file = self.TryGetNetworkFile(url="%s/%s/LATEST" % (self.UpdateServerMaster(), train),
+        url = "%s/%s/LATEST" % (self.UpdateServerMaster(), train)
+        mani_file = self.TryGetNetworkFile(url=url,
                                       reason="GetLatestManifest",
+                                      cache=True,
                                       )
         if mani_file is None:
             log.debug("Could not get latest manifest file for train %s" % train)
         else:
-            rv = Manifest.Manifest(self, require_signature=require_signature)
-            rv.LoadFile(mani_file)
-            mani_file.close()
+            try:
+                rv = self.LoadNetworkManifest(url, mani_file, require_signature)
+            finally:
+                mani_file.close()
+        return rv
+
+    def LoadNetworkManifest(self, url, mani_file, require_signature=False):
+        # Load a manifest fetched from url.  If it's the same content
+        # we've already loaded (and verified, if needed), a copy of that
+        # one is returned.  Only this process's own verification is
+        # trusted; nothing about it is kept on disk, where it could
+        # be forged.
+        data = mani_file.read()
+        mani_file.seek(0)
+        digest = hashlib.sha256(data).hexdigest()
+        with self._session_lock:
+            cached = self._manifest_cache.get(url)
+        if cached and cached[0] == digest and (cached[1] or not require_signature):
+            log.debug("Using already-loaded manifest for %s" % url)
+            return cached[2].Copy()
+
+        rv = Manifest.Manifest(self, require_signature=require_signature)
+        rv.LoadFile(mani_file)
+        with self._session_lock:
+            self._manifest_cache[url] = (digest, require_signature, rv.Copy())
         return rv
 
     def CurrentPackageVersion(self, pkgName):
@@ -1144,7 +2752,8 @@ class Configuration(object):
             return None
 
     def FindPackageFile(self, package, upgrade_from=None, handler=None,
-                        save_dir=None, pkg_type=None, ignore_space=False):
+                        save_dir=None, pkg_type=None, ignore_space=False,
+                        cancel=None):
         # Given a package, and optionally a version to upgrade from, find
         # the package file for it.  Returns a file-like
         # object for the package file.
@@ -1158,6 +2767,8 @@ class Configuration(object):
         # the manifest file, so we won't do the checksum verification --
         # we'll only go by name.
         # If it can't find one, it returns None
+        # cancel is passed on to TryGetNetworkFile, so a concurrent
+        # download can be stopped part-way through.
 
         # We have at least one, and at most two, files
         # to look for.
@@ -1168,6 +2779,8 @@ class Configuration(object):
         package_files = []
         if pkg_type is not PkgFileDeltaOnly:
             package_files.append({"Filename": package.FileName(), "Checksum": package.Checksum()})
+            if package.Size():
+                package_files[0][Package.SIZE_KEY] = package.Size()
         # The next one is the delta package, if it exists.
         # For that, we look through package.Updates(), looking for one that
         # has the same version as what is currently installed.
@@ -1198,81 +2811,177 @@ class Configuration(object):
                 pass
 
         # At this point, package_files now has at least one element.
-        # We want to search in this order:
+        # Each one may be in the package directory, the package store,
+        # or on the network; PlanPackageSources puts those in order of
+        # estimated cost.  Without sizes, that's the old search order:
         # * Local full copy
         # * Local delta copy
+        # * Stored delta copy
+        # * Stored full copy
         # * Network delta copy
         # * Network full copy
-
-        # We want to look for each one in _package_dir and off the network.
         # If we find it, and the checksum matches, we're good to go.
-        # If not, we have to grab it off the network and use that.  We can't
-        # check that checksum until we get it.
+        # Network copies are checked as they're downloaded.
+        store = self.PackageStore()
+        plan = self.PlanPackageSources(package, package_files, store=store)
+        full_size = package.Size()
+
         pkg_exception = None
-        for search_attempt in package_files:
-            # First try the local copy.
-            log.debug("Searching for %s" % search_attempt["Filename"])
-            try:
-                if self._package_dir:
+        file = None
+        for step in plan:
+            search_attempt = step["attempt"]
+            file = None
+            if step["source"] == "local":
+                try:
                     p = "{0}/{1}".format(self._package_dir, search_attempt["Filename"])
-                    if os.path.exists(p):
-                        file = open(p, 'rb')
-                        log.debug("Found package file %s" % p)
-                        if search_attempt["Checksum"]:
-                            h = ChecksumFile(file)
-                            if h == search_attempt["Checksum"]:
-                                return file
-                            else:
-                                pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(search_attempt["Filename"]))
-                        else:
-                            # No checksum for the file, so we'll just go with it.
-                            return file
-            except:
-                pass
+                    file = open(p, 'rb')
+                    log.debug("Found package file %s" % p)
+                    if search_attempt["Checksum"]:
+                        h = ChecksumFile(file)
+                        if h != search_attempt["Checksum"]:
+                            pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(search_attempt["Filename"]))
+                            file.close()
+                            file = None
+                    # No checksum for the file, so we'll just go with it.
+                except:
+                    file = None
+            elif step["source"] == "store":
+                if save_dir:
+                    p = store.LinkInto(search_attempt["Checksum"],
+                                       save_dir + "/" + search_attempt["Filename"])
+                else:
+                    p = store.Lookup(search_attempt["Checksum"])
+                if p:
+                    log.debug("Found %s in the package store" % search_attempt["Filename"])
+                    file = open(p, "rb")
+            else:
+                pFile = "Packages/%s" % search_attempt["Filename"]
+                save_name = None
+                if save_dir:
+                    save_name = save_dir + "/" + search_attempt["Filename"]
 
-        for search_attempt in reversed(package_files):
-            # Next we try to get it from the network.
-            pFile = "Packages/%s" % search_attempt["Filename"]
-            save_name = None
-            if save_dir:
-                save_name = save_dir + "/" + search_attempt["Filename"]
+                try:
+                    # The checksum (if any) is verified while downloading;
+                    # TryGetNetworkFile removes the file if it doesn't match.
+                    file = self.TryGetNetworkFile(
+                        file=pFile,
+                        handler=handler,
+                        pathname=save_name,
+                        reason="DownloadPackageFile",
+                        intr_ok=True,
+                        ignore_space=ignore_space,
+                        cancel=cancel,
+                        checksum=search_attempt["Checksum"],
+                    )
+                except Exceptions.UpdateDownloadCancelledException:
+                    # No point in trying the other package files
+                    raise
+                except Exceptions.ChecksumFailException:
+                    log.debug("Checksum doesn't match for %s, continuing" % pFile)
+                    pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(pFile))
+                    continue
+                except BaseException as e:
+                    log.debug("Trying to get %s, got exception %s, continuing" % (pFile, str(e)))
+                    continue
 
-            try:
-                file = None
-                file = self.TryGetNetworkFile(
-                    file=pFile,
-                    handler=handler,
-                    pathname=save_name,
-                    reason="DownloadPackageFile",
-                    intr_ok=True,
-                    ignore_space=ignore_space
-                )
-            except BaseException as e:
-                log.debug("Trying to get %s, got exception %s, continuing" % (pFile, str(e)))
-                continue
+                if file and store and save_name and search_attempt["Checksum"]:
+                    store.Add(save_name, search_attempt["Checksum"])
 
             if file:
-                if search_attempt["Checksum"]:
-                    h = ChecksumFile(file)
-                    if h == search_attempt["Checksum"]:
-                        return file
-                    else:
-                        # For an interrupted download of a package file,
-                        # this won't be reached due to an exception.
-                        log.debug("Checksum doesn't match, removing file")
-                        if save_name:
-                            os.unlink(save_name)
-                        pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(pFile))
-                else:
-                    # No checksum for the file, so we just go with it
-                    return file
+                self.RecordPackagePlan(package, step, full_size)
+                return file
 
-        if file:
-            file.close()
         if pkg_exception:
             raise pkg_exception
         raise Exceptions.UpdatePackageNotFound(package.Name())
 
+    def NetworkEstimate(self):
+        # Returns the (latency, throughput) we expect from the best of
+        # the update server and its mirrors, based on past transfers.
+        servers = [self.UpdateServerURL()] + self.UpdateServerMirrors()
+        stats = self.MirrorStatistics(self.RankMirrors(servers)[0])
+        latency = stats.latency if stats.latency is not None else PLANNER_DEFAULT_LATENCY
+        throughput = stats.throughput or PLANNER_DEFAULT_THROUGHPUT
+        rate_limit = self.NetworkRateLimiter().Rate()
+        if rate_limit:
+            throughput = min(throughput, rate_limit)
+        return (latency, throughput)
+
+    def PlanPackageSources(self, package, package_files, store=None):
+        # Given the candidate files from FindPackageFile (the full
+        # package, and possibly a delta), return the places to try
+        # getting them from, cheapest first, as a list of dictionaries:
+        # "source" is "local" (the package directory), "store" (the
+        # package store), or "network"; "attempt" is the package_files
+        # entry; "cost" is the estimated time, in seconds; and "bytes"
+        # is how much would come over the network.
+        # Local copies cost the time to read (and check) them.  A delta
+        # is only chosen over the full package if it is expected to be
+        # at least PLANNER_DELTA_SAVING cheaper, since the full package
+        # doesn't depend on what's installed.  Anything without a size
+        # keeps the old search order (see FindPackageFile).
+        (latency, throughput) = self.NetworkEstimate()
+        full_size = None
+        for attempt in package_files:
+            if not attempt.get("Delta"):
+                full_size = attempt.get(Package.SIZE_KEY)
+
+        plan = []
+        for attempt in package_files:
+            delta = bool(attempt.get("Delta"))
+            size = attempt.get(Package.SIZE_KEY)
+            sources = []
+            if self._package_dir and \
+               os.path.exists("{0}/{1}".format(self._package_dir, attempt["Filename"])):
+                sources.append(("local", 1 if delta else 0))
+            if store and attempt["Checksum"] and os.path.exists(store.Path(attempt["Checksum"])):
+                sources.append(("store", 2 if delta else 3))
+            sources.append(("network", 4 if delta else 5))
+            for (source, order) in sources:
+                if source == "network":
+                    cost = latency + (float(size or 0) / throughput)
+                    nbytes = size
+                else:
+                    cost = float(size or 0) / PLANNER_LOCAL_THROUGHPUT
+                    nbytes = 0
+                if delta and size and full_size:
+                    cost = cost / (1.0 - PLANNER_DELTA_SAVING)
+                plan.append({
+                    "source" : source,
+                    "attempt" : attempt,
+                    "cost" : cost,
+                    "bytes" : nbytes,
+                    "order" : order,
+                })
+        plan.sort(key=lambda step: (step["cost"], step["order"]))
+        for step in plan:
+            log.debug("PlanPackageSources(%s):  %s %s, cost %.2fs, %s bytes" %
+                      (package.Name(), step["source"], step["attempt"]["Filename"],
+                       step["cost"], step["bytes"]))
+        return plan
+
+    def RecordPackagePlan(self, package, step, full_size):
+        # Log, and count, which source FindPackageFile used, and how
+        # many bytes that saved compared to downloading the full package.
+        kind = "delta" if step["attempt"].get("Delta") else "full"
+        nbytes = step["bytes"] or 0
+        saved = (full_size - nbytes) if full_size else 0
+        log.info("FindPackageFile(%s):  using %s package %s from %s (%d bytes over the network, %d saved)" %
+                 (package.Name(), kind, step["attempt"]["Filename"], step["source"], nbytes, saved))
+        with self._session_lock:
+            self._plan_stats["packages"] += 1
+            self._plan_stats[kind] += 1
+            self._plan_stats[step["source"]] += 1
+            self._plan_stats["network_bytes"] += nbytes
+            self._plan_stats["bytes_saved"] += saved
+        return
+
+    def PackagePlanStatistics(self):
+        # Counts of which packages, and sources, FindPackageFile chose,
+        # and how many bytes that saved over full downloads.
+        with self._session_lock:
+            return self._plan_stats.copy()
+
 _system_config = None
 def SystemConfiguration():
     global _system_config
@@ -1329,7 +3038,7 @@ def check_ftype(objs):
         ed = dict([
             ('path', objs["path"]),
             ('problem', 'Expected {0}, Got {1}'.format(objs["kind"], ftype)),
-            ('pkgdb_entry', objs)
+            ('pkgdb_entry', dict(objs))
         ])
     pdtmp = ''
     if perm != objs["mode"]:
@@ -1342,7 +3051,7 @@ def check_ftype(objs):
         pd = dict([
             ('path', objs["path"]),
             ('problem', pdtmp[1:]),
-            ('pkgdb_entry', objs)
+            ('pkgdb_entry', dict(objs))
         ])
     return ed, pd
 
@@ -1366,14 +3075,14 @@ def do_verify(verify_handler=None):
     pkgdb = PackageDB(create=False)
     if pkgdb is None:
         raise IOError("Cannot get pkgdb connection")
-    filelist = pkgdb.FindFilesForPackage()
-    total_files = len(filelist)
+    # The entries are read a batch at a time, rather than all at once.
+    total_files = pkgdb.CountFiles()
 
-    for objs in filelist:
+    for objs in pkgdb.IterFiles():
         i = i+1
         if verify_handler is not None:
             verify_handler(i, total_files, objs["path"])
-        tmp = b''  # Just a temp. variable to store the text to be hashed
+        hash = hashlib.sha256()
         if is_ignore_path(objs["path"]):
             continue
         if not os.path.lexists(objs["path"]):
@@ -1386,7 +3095,7 @@ def do_verify(verify_handler=None):
             error_list['notfound'].append(dict([
                 ('path', objs["path"]),
                 ('problem', 'path does not exsist'),
-                ('pkgdb_entry', objs)
+                ('pkgdb_entry', dict(objs))
             ]))
             continue
 
@@ -1402,24 +3111,26 @@ def do_verify(verify_handler=None):
             tmp = os.readlink(objs["path"]).encode('utf8')
             if tmp.startswith(b'/'):
                 tmp = tmp[1:]
+            hash.update(tmp)
 
         if objs["kind"] == "file":
             if objs["path"].endswith(".pyc"):
                 continue
             with open(objs["path"], 'rb') as f:
-                tmp = f.read()
+                for piece in iter(lambda: f.read(1024 * 1024), b''):
+                    hash.update(piece)
 
         # Do this last (as it needs to be done for all, but dirs, as dirs have no checksum d'oh!)
         if (
             objs["kind"] != 'dir' and
             objs["checksum"] and
             objs["checksum"] != "-" and
-            hashlib.sha256(tmp).hexdigest() != objs["checksum"]
+            hash.hexdigest() != objs["checksum"]
            ):
             error_flag = True
             error_list['checksum'].append(dict([
                 ('path', objs["path"]),
                 ('problem', 'checksum does not match'),
-                ('pkgdb_entry', objs)
+                ('pkgdb_entry', dict(objs))
             ]))
     return error_flag, error_list, warn_flag, warn_list
@@ -43,6 +43,13 @@ class UpdateNetworkConnectionException(UpdateNetworkException):
     """
     pass
 
+class UpdateDownloadCancelledException(UpdateNetworkException):
+    """
+    A transfer was stopped because the download it was part
+    of was cancelled (e.g., another package failed).
+    """
+    pass
+
 class UpdateBadFrozenFile(Exception):
     """
     Indicates a frozen update file was bad
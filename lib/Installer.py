@@ -6,13 +6,20 @@ import stat
 import json
 import tarfile
 import hashlib
+import io
 import logging
 import tempfile
+import threading
 import subprocess
 from . import modified_call
+from .PackageFile import PathIndex
 
 debug = 0
 verbose = False
+# Whether each extracted file is fsync'd before it's renamed into
+# place.  Off by default:  ApplyUpdate() turns sync off for the new
+# boot environment while installing anyway.
+fsync = False
 
 log = logging.getLogger('freenasOS.Installer')
 
@@ -61,6 +68,22 @@ PKG_DELTA_STYLE_KEY = "style"
 
 PKG_MANIFEST_NAME = "+MANIFEST"
 
+# How many package files GetPackages(pipeline=True) fetches at once.
+# They're still installed in order.
+PIPELINE_WORKERS = 1
+
+# How many threads install_file() uses to write out files (1 means
+# it's all done as the package is read).  With more than one, files
+# up to EXTRACT_SPOOL_SIZE bytes are read into memory and written by
+# a worker, at most EXTRACT_BACKLOG files per worker waiting; bigger
+# ones are written as they're read.
+EXTRACT_WORKERS = 1
+EXTRACT_SPOOL_SIZE = 1024 * 1024
+EXTRACT_BACKLOG = 4
+
+# How many files RemoveFiles() unlinks at once.
+REMOVE_WORKERS = 4
+
 # These are the keys for the scripts
 PKG_SCRIPTS = [
     "pre-install",
@@ -177,6 +200,19 @@ def RemoveFile(path):
     return True
 
 
+# Remove a list of files, as above, on up to workers threads.
+# Returns a list of the paths that couldn't be removed.
+def RemoveFiles(paths, workers=REMOVE_WORKERS):
+    if workers <= 1 or len(paths) <= 1:
+        return [path for path in paths if RemoveFile(path) == False]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(RemoveFile, paths))
+    return [path for (path, removed) in zip(paths, results) if removed == False]
+
+
 # Like the above, but for a directory.
 def RemoveDirectory(path):
     st = None
@@ -226,17 +262,6 @@ def SetPosix(path, meta):
                 raise e
 
 
-def EntryInDictionary(name, mDict, prefix):
-    if (name in mDict):
-        return True
-    if prefix is not None:
-        if (prefix + name in mDict):
-            return True
-        if (prefix + name).startswith("/") == False:
-            if "/" + prefix + name in mDict:
-                return True
-    return False
-
 # Constants used for tar meta dictionaries.
 TAR_UID_KEY = "uid"
 TAR_GID_KEY = "gid"
@@ -353,7 +378,7 @@ def RunPkgScript(scripts, type, root=None, **kwargs):
 # root directory, and an optional prefix and hash.
 
 
-def ExtractEntry(tf, entry, root, prefix=None, mFileHash=None):
+def ExtractEntry(tf, entry, root, prefix=None, mFileHash=None, fileData=None):
     # This bit of code tries to turn the
     # mixture of root, prefix, and pathname into something
     # we can both manipulate, and something we can put into
@@ -451,62 +476,58 @@ def ExtractEntry(tf, entry, root, prefix=None, mFileHash=None):
     # Process the entry.  We look for a file, directory,
     # symlink, or hard link.
     if entry.isfile():
-        fileData = tf.extractfile(entry)
-        # Is this a problem?  Keeping the file in memory?
-        # Note that we write the file out later, so this allows
-        # us to not worry about the buffer.
+        # fileData is the contents, if they've already been read from tf.
+        if fileData is None:
+            fileData = tf.extractfile(entry)
+        # The contents are written, and hashed, once, into a new file
+        # next to the real one, which is then renamed into place; so
+        # the old file is there until the new one is complete.  The
+        # temporary name is short and fixed-length, so it works for
+        # any name that fits.
         try:
-            temp_entry = tempfile.TemporaryFile(dir=os.path.dirname(full_path))
+            (fd, newfile) = tempfile.mkstemp(prefix=".pkg.", suffix=".new", dir=dirname)
         except:
-            s = "Cannot create temporary file in %s" % os.path.dirname(full_path)
+            s = "Cannot create temporary file in %s" % dirname
             log.error(s)
             raise
         hash = hashlib.sha256()
-        while True:
-            d = fileData.read(1024 * 1024)
-            if d:
-                hash.update(d)
-                temp_entry.write(d)
-            else:
-                break
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    d = fileData.read(1024 * 1024)
+                    if d:
+                        hash.update(d)
+                        f.write(d)
+                    else:
+                        break
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except:
+            RemoveFile(newfile)
+            raise
         hash = hash.hexdigest()
-        temp_entry.seek(0)
         # PKGNG sets hash to "-" if it's not computed.
         if mFileHash != "-":
             if hash != mFileHash:
                 log.error("%s hash does not match manifest" % entry.name)
         type = "file"
-        # First we try to create the file.
-        # If that doesn't work, we try to create a
-        # new file (how would this get cleaned up?),
-        # and then rename it in place.
-        # We remove any flags on it -- if there are
-        # supposed to be any, SetPosix() will get them.
-        # (We hope.)
+        # We remove any flags on the old file, so it can be
+        # replaced -- if there are supposed to be any, SetPosix()
+        # will get them.  (We hope.)
         try:
             os.lchflags(full_path, 0)
         except:
             pass
-        newfile = None
         try:
-            f = open(full_path, "wb")
+            os.rename(newfile, full_path)
         except:
-            newfile = full_path + ".new"
-            f = open(newfile, "wb")
-        while True:
-            d = temp_entry.read(1024 * 1024)
-            if d:
-                f.write(d)
-            else:
-                break
-        f.close()
-        temp_entry.close()
-        if newfile is not None:
             try:
-                os.rename(newfile, full_path)
-            except:
                 os.rename(full_path, "%s.old" % full_path)
                 os.rename(newfile, full_path)
+            except:
+                RemoveFile(newfile)
+                raise
         SetPosix(full_path, meta)
     elif entry.isdir():
         # If the directory already exists, we don't care.
@@ -612,6 +633,134 @@ def ExtractEntry(tf, entry, root, prefix=None, mFileHash=None):
         return None
 
 
+class ParallelExtractor(object):
+    """
+    Runs ExtractEntry() for the members of a package on a pool
+    of writer threads.  The tar stream is only read by the calling
+    thread:  small files are read into memory, and a worker creates,
+    hashes, and sets the metadata of each one; everything else is
+    extracted right away.  Before an entry is extracted or handed
+    off, the pending ones it depends on are waited for, so it comes
+    out the same as when extracting in order.  Results() returns what
+    ExtractEntry() did, in tar order.
+    """
+    def __init__(self, root, prefix=None, workers=EXTRACT_WORKERS):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._root = root
+        self._prefix = prefix
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._backlog = threading.BoundedSemaphore(workers * EXTRACT_BACKLOG)
+        self._results = []
+        self._pending = {}
+        self._failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.Close()
+
+    def Close(self):
+        self._executor.shutdown(wait=True)
+        return
+
+    def _Done(self, future):
+        self._backlog.release()
+        if future.cancelled() or future.exception() is not None:
+            self._failed = True
+
+    def _Run(self, entry, mFileHash, fileData):
+        return ExtractEntry(None, entry, self._root, self._prefix, mFileHash, fileData=fileData)
+
+    def _Path(self, name, relative=True):
+        # The path name refers to, relative to the root.  Member
+        # names are relative to the prefix, unless they're absolute;
+        # a hard link's target is always relative to the root.
+        if name.startswith("./"):
+            name = name[2:]
+        if relative and self._prefix and not name.startswith("/"):
+            name = self._prefix + "/" + name
+        return os.path.normpath("/" + name).lstrip("/")
+
+    def _Depends(self, entry):
+        # The pending entries that have to be written before entry:
+        # an earlier one for the same path, or for a directory it's
+        # in; anything under it (a directory's mode or flags, or
+        # replacing it, would get in their way); and a hard link's
+        # target.  Ones that are done are dropped along the way.
+        path = self._Path(entry.name)
+        paths = set([path])
+        parent = os.path.dirname(path)
+        while parent:
+            paths.add(parent)
+            parent = os.path.dirname(parent)
+        if entry.islnk():
+            paths.add(self._Path(entry.linkname, relative=False))
+        below = path + "/"
+        rv = []
+        for (key, future) in list(self._pending.items()):
+            if future.done():
+                del self._pending[key]
+            elif key in paths or key.startswith(below):
+                rv.append(future)
+        return (path, rv)
+
+    def Wait(self, entry=None):
+        # Wait for the pending entries entry depends on, or all of them.
+        if entry is None:
+            futures = list(self._pending.values())
+            self._pending = {}
+        else:
+            (_, futures) = self._Depends(entry)
+        for future in futures:
+            future.result()
+        return
+
+    def Extract(self, tf, entry, mFileHash=None):
+        from concurrent.futures import Future
+
+        if self._failed:
+            # Stop reading; Results() will raise the error.
+            self.Wait()
+        (path, futures) = self._Depends(entry)
+        for dependency in futures:
+            dependency.result()
+
+        if not entry.isfile() or entry.size > EXTRACT_SPOOL_SIZE:
+            # These are done right here:  most don't take long, and
+            # big files are written as they're read, rather than
+            # being copied somewhere first.
+            future = Future()
+            future.set_result(ExtractEntry(tf, entry, self._root, self._prefix, mFileHash))
+            self._results.append(future)
+            return
+
+        source = tf.extractfile(entry)
+        try:
+            fileData = io.BytesIO(source.read())
+        finally:
+            source.close()
+        self._backlog.acquire()
+        future = self._executor.submit(self._Run, entry, mFileHash, fileData)
+        future.add_done_callback(self._Done)
+        self._pending[path] = future
+        self._results.append(future)
+        return
+
+    def Results(self):
+        # Wait for everything, and return the list of ExtractEntry()
+        # results (leaving out the None ones).  If any of them failed,
+        # the first exception is raised.
+        self.Wait()
+        rv = []
+        for future in self._results:
+            result = future.result()
+            if result is not None:
+                rv.append(result)
+        return rv
+
+
 def install_path(pkgfile, dest):
     try:
         f = open(pkgfile, "r")
@@ -626,13 +775,15 @@ def install_file(pkgfile, dest, **kwargs):
     from . import Configuration
     global debug, verbose, dryrun
     prefix = None
-    # We explicitly want to use the pkgdb from the destination
-    pkgdb = Configuration.PackageDB(dest)
+    # We explicitly want to use the pkgdb from the destination.
+    # The caller may pass one in (eg, with a session open).
+    pkgdb = kwargs.pop("pkgdb", None) or Configuration.PackageDB(dest)
     pkgScripts = None
     upgrade_aware = False
     progress = kwargs.pop("progress", None)
     if progress is None:
         progress = lambda **kwargs: True
+    workers = kwargs.pop("workers", None) or EXTRACT_WORKERS
     
     try:
         t = tarfile.open(fileobj=pkgfile)
@@ -778,17 +929,19 @@ def install_file(pkgfile, dest, **kwargs):
             # Next step for a delta package is to remove any removed files and directories.
             # This is done in both the database and the filesystem.
             # If we can't remove a directory due to ENOTEMPTY, we don't care.
+            full_paths = {}
             for file in pkgDeletedFiles:
                 if dest:
-                    full_path = dest + "/" + file
+                    full_paths[dest + "/" + file] = file
                 else:
-                    full_path = "/" + file
-                if RemoveFile(full_path) == False:
-                    if debug:
-                        log.debug("Could not remove file %s" % file)
-                    # Ignor error for now
-                pkgdb.RemoveFileEntry(file)
-            # Now we try to delete the directories.
+                    full_paths["/" + file] = file
+            for full_path in RemoveFiles(list(full_paths)):
+                if debug:
+                    log.debug("Could not remove file %s" % full_paths[full_path])
+                # Ignor error for now
+            pkgdb.RemoveFileEntries(pkgDeletedFiles)
+            # Now we try to delete the directories.  These are done
+            # in order, since a parent may be after its children.
             for dir in pkgDeletedDirs:
                 if verbose or debug:
                     log.debug("Attempting to remove directory %s" % dir)
@@ -797,7 +950,7 @@ def install_file(pkgfile, dest, **kwargs):
                 else:
                     full_path = "/" + dir
                 RemoveDirectory(full_path)
-                pkgdb.RemoveFileEntry(dir)
+            pkgdb.RemoveFileEntries(pkgDeletedDirs)
             # Later on, when the package is upgraded, the scripts in the database are deleted.
             # So we don't have to do that now.
         else:
@@ -875,37 +1028,35 @@ def install_file(pkgfile, dest, **kwargs):
     # Go through the tarfile, looking for entries in the manifest list.
     pkgFiles = []
     progress_count = 0
+    extractor = None
+    if workers > 1:
+        extractor = ParallelExtractor(dest, prefix, workers=workers)
+    # The manifest may have relative or absolute paths, and tar may
+    # remove a leading slash to make us secure, and names may be
+    # relative to the prefix; the index takes care of all of that.
+    index = PathIndex(mfiles, mdirs, prefix)
     while member is not None:
-        # To figure out the hash, we need to look
-        # at <file>, <prefix + file>, and both of those
-        # with and without a leading "/".  (Why?  Because
-        # the manifest may have relative or absolute paths,
-        # and tar may remove a leading slash to make us secure.)
-        # We also have to look in the directories hash
-        # print >> sys.stderr, "member = %s, prefix = %s" % (member.name, prefix)
-        mFileHash = "-"
-        if member.name in mfiles:
-            mFileHash = mfiles[member.name]
-        elif member.name.startswith("/") == False and ("/" + member.name) in mfiles:
-            mFileHash = mfiles["/" + member.name]
-        elif prefix + member.name in mfiles:
-            mFileHash = mfiles[prefix + member.name]
-        elif (prefix + member.name).startswith("/") == False:
-            if "/" + prefix + member.name in mfiles:
-                mFileHash = mfiles["/" + prefix + member.name]
-        else:
-            # If it's not in the manifest, then ignore it
-            # It may be a directory, however, so let's check
-            if EntryInDictionary(member.name, mdirs, prefix) == False:
-                # If we don't skip it, we infinite loop.  That's bad.
-                member = t.next()
-                continue
+        # Directories have no hash.
+        found = index.Lookup(member.name)
+        if found is None:
+            # If it's not in the manifest, then ignore it.
+            # If we don't skip it, we infinite loop.  That's bad.
+            member = t.next()
+            continue
+        (mFileHash, dc) = found
         if pkgDeltaVersion is not None:
             if verbose or debug:
                 log.debug("Extracting %s from delta package" % member.name)
-        list = ExtractEntry(t, member, dest, prefix, mFileHash)
-        if list is not None:
-            pkgFiles.append((pkgName,) + list)
+        if extractor:
+            try:
+                extractor.Extract(t, member, mFileHash)
+            except:
+                extractor.Close()
+                raise
+        else:
+            file_entry = ExtractEntry(t, member, dest, prefix, mFileHash)
+            if file_entry is not None:
+                pkgFiles.append((pkgName,) + file_entry)
         progress_count += 1
         try:
             progress(index=progress_count, total=len(mfiles)+len(mdirs), name=member.name)
@@ -913,6 +1064,11 @@ def install_file(pkgfile, dest, **kwargs):
             log.debug("Got an exception calling the progress handler", exc_info=True)
         member = t.next()
 
+    if extractor:
+        with extractor:
+            for file_entry in extractor.Results():
+                pkgFiles.append((pkgName,) + file_entry)
+
     t.close()
 
     if len(pkgFiles) > 0:
@@ -1008,7 +1164,9 @@ class Installer(object):
     _conf = None
     _manifest = None
     _packages = []
+    _pending = None
     _trampoline = True
+    _extract_workers = EXTRACT_WORKERS
     
     def __init__(self, config=None, manifest=None, root=None):
         self._conf = config
@@ -1027,6 +1185,7 @@ class Installer(object):
         return
 
     def __del__(self):
+        self.CancelPackages()
         if self._packages:
             for pkg in self._packages:
                 for pkgfile in pkg.values():
@@ -1040,6 +1199,13 @@ class Installer(object):
     @trampoline.setter
     def trampoline(self, v):
         self._trampoline = v
+
+    @property
+    def extract_workers(self):
+        return self._extract_workers
+    @extract_workers.setter
+    def extract_workers(self, v):
+        self._extract_workers = max(1, int(v))
         
     def SetRoot(self, root):
         self._root = root
@@ -1052,40 +1218,115 @@ class Installer(object):
     def Packages(self):
         return self._packages
     
+    def SetFsync(self, b):
+        global fsync
+        fsync = b
+        return
+
     def SetVerbose(self, b):
         global verbose
         verbose = b
         return
 
-    def GetPackages(self, pkgList=None, handler=None):
+    def GetPackages(self, pkgList=None, handler=None, pipeline=False,
+                    workers=PIPELINE_WORKERS):
         # Load the packages in pkgList.  If pkgList is not
         # given, it loads the packages in the manifest.
         # This should change.
+        # If pipeline is set, this returns right away, and the
+        # package files are found (downloaded, if need be, and
+        # verified) in the background; InstallPackages() installs
+        # each one as soon as it's ready.  Until then, Packages()
+        # has None for the file.
+        self.CancelPackages()
         self._packages = []
         if pkgList is None:
             pkgList = self._manifest.Packages()
-        for i, pkg in enumerate(pkgList):
+
+        def find(i, pkg, cancel=None):
             if handler is not None:
                 get_file_handler = handler(index=i + 1, pkg=pkg, pkgList=pkgList)
             else:
                 get_file_handler = None
-            pkgFile = self._conf.FindPackageFile(pkg, handler=get_file_handler)
+            pkgFile = self._conf.FindPackageFile(pkg, handler=get_file_handler, cancel=cancel)
             if pkgFile is None:
                 raise InstallerPackageNotFoundException("%s-%s" % (pkg.Name(), pkg.Version()))
-            self._packages.append({pkg.Name(): pkgFile})
+            return pkgFile
+
+        if pipeline:
+            from concurrent.futures import ThreadPoolExecutor
+
+            cancel = threading.Event()
+            executor = ThreadPoolExecutor(max_workers=workers)
+            futures = []
+            for i, pkg in enumerate(pkgList):
+                self._packages.append({pkg.Name(): None})
+                futures.append(executor.submit(find, i, pkg, cancel=cancel))
+            self._pending = (executor, cancel, futures)
+            return True
+
+        for i, pkg in enumerate(pkgList):
+            self._packages.append({pkg.Name(): find(i, pkg)})
         # At this point, self._packages has all of the packages we want to install,
         # ready for installation
         return True
 
+    def _WaitPackage(self, index):
+        # Wait for the pipelined package at index, and return its file.
+        (executor, cancel, futures) = self._pending
+        [pkgname] = self._packages[index].keys()
+        pkgFile = futures[index].result()
+        self._packages[index][pkgname] = pkgFile
+        return pkgFile
+
+    def CancelPackages(self):
+        # Stop fetching any pipelined packages still pending,
+        # and close the files that won't be installed.
+        # InstallPackages() does this when it's done.
+        if self._pending is None:
+            return
+        (executor, cancel, futures) = self._pending
+        self._pending = None
+        cancel.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for i, future in enumerate(futures):
+            if future.cancelled() or future.exception() is not None:
+                continue
+            [pkgname] = self._packages[i].keys()
+            if self._packages[i][pkgname] is None:
+                future.result().close()
+        return
+
     def InstallPackages(self, progressFunc=None, handler=None):
-        for i, pkg in enumerate(self._packages):
-            for pkgname in pkg:
-                log.debug("Installing package %s" % pkg)
-                if handler is not None:
-                    handler(index=i + 1, name=pkgname, packages=self._packages)
-                if install_file(pkg[pkgname], self._root,
-                                progress=progressFunc,
-                                trampoline=self.trampoline) is False:
-                    log.error("Unable to install package %s" % pkgname)
-                    return False
+        from . import Configuration
+
+        # All of the packages share one database connection; each
+        # package's changes are committed once it's installed, so a
+        # failure (or crash) leaves the database as it was after the
+        # last complete package.
+        pkgdb = Configuration.PackageDB(self._root)
+        try:
+            with pkgdb:
+                for i, pkg in enumerate(self._packages):
+                    for pkgname in pkg:
+                        pkgFile = pkg[pkgname]
+                        if pkgFile is None and self._pending:
+                            log.debug("Waiting for package %s" % pkgname)
+                            pkgFile = self._WaitPackage(i)
+                        log.debug("Installing package %s" % pkg)
+                        if handler is not None:
+                            handler(index=i + 1, name=pkgname, packages=self._packages)
+                        if install_file(pkgFile, self._root,
+                                        progress=progressFunc,
+                                        trampoline=self.trampoline,
+                                        workers=self.extract_workers,
+                                        pkgdb=pkgdb) is False:
+                            log.error("Unable to install package %s" % pkgname)
+                            pkgdb.Rollback()
+                            return False
+                        pkgdb.Commit()
+        finally:
+            self.CancelPackages()
         return True
@@ -1,8 +1,12 @@
 from __future__ import print_function
 import os
+import copy
+import hashlib
 import json
 import logging
 import re
+import threading
+import time
 
 from . import Exceptions, Package
 
@@ -82,6 +86,213 @@ def VerificationCertificateFile(manifest):
 class ChecksumFailException(Exception):
     pass
 
+# Cache of what VerifySignature needs:  the store with the root CA and
+# CRL, and the parsed signing certificates.  Files are keyed by
+# (path, mtime, size), so a change on disk causes a reload; the CRL is
+# kept (in memory, and in the network cache) until its nextUpdate time.
+# The CRL is loaded and fetched without _trust_lock held, so a fetch
+# doesn't hold up verifications that don't need it; _trust_crl_lock
+# keeps it to one fetch at a time.  A failed fetch isn't retried for
+# CRL_RETRY_DELAY seconds.
+CRL_RETRY_DELAY = 60
+_trust_lock = threading.Lock()
+_trust_crl_lock = threading.Lock()
+_trust_store = None
+_trust_crl = None
+_trust_crl_failed = None
+_trust_certs = {}
+_trust_stats = { "hits" : 0, "misses" : 0, "crl_fetches" : 0 }
+
+def TrustStoreStats():
+    # Returns the trust store cache counters.
+    with _trust_lock:
+        return _trust_stats.copy()
+
+def ClearTrustStore():
+    # Forget everything cached for signature verification.
+    global _trust_store, _trust_crl, _trust_crl_failed, _trust_certs
+    with _trust_lock:
+        _trust_store = None
+        _trust_crl = None
+        _trust_crl_failed = None
+        _trust_certs = {}
+    return
+
+def _FileKey(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_mtime_ns, st.st_size)
+
+def _LoadCRL(data):
+    # Returns the CRL in data, and when it should be refreshed
+    # (seconds since the epoch, or None if it doesn't say).
+    import calendar
+    import OpenSSL.crypto as Crypto
+
+    crl = Crypto.load_crl(Crypto.FILETYPE_PEM, data)
+    next_update = None
+    try:
+        c_crl = crl.to_cryptography()
+        when = getattr(c_crl, "next_update_utc", None) or c_crl.next_update
+        if when:
+            next_update = calendar.timegm(when.utctimetuple())
+    except:
+        log.debug("Could not get CRL nextUpdate", exc_info=True)
+    return (crl, next_update)
+
+def _CachedCRL(key):
+    # Returns (True, (crl, digest)) if the CRL in memory (which may
+    # be None, after a recent failure) can be used, or (False, None)
+    # if it has to be loaded.  Called with _trust_lock held.
+    if _trust_crl and _trust_crl[0] == key \
+       and _trust_crl[2] and _trust_crl[2] > time.time():
+        return (True, (_trust_crl[1], _trust_crl[3]))
+    if _trust_crl_failed and time.time() - _trust_crl_failed < CRL_RETRY_DELAY:
+        return (True, (None, None))
+    return (False, None)
+
+def _SetCRL(entry):
+    # Publish a newly-loaded CRL (key, crl, next_update, digest),
+    # or None if it couldn't be gotten.
+    global _trust_crl, _trust_crl_failed
+    with _trust_lock:
+        _trust_crl = entry
+        _trust_crl_failed = None if entry else time.time()
+    return (entry[1], entry[3]) if entry else (None, None)
+
+def _TrustCRL(config):
+    # Returns (crl, digest) for the iX CRL, where digest is the
+    # SHA256 of its contents, or (None, None).  Called without
+    # _trust_lock held.
+    from . import IX_CRL
+
+    crl_path = config.NetworkCachePath(IX_CRL)
+    key = _FileKey(crl_path) if crl_path else None
+    with _trust_lock:
+        (found, rv) = _CachedCRL(key)
+    if found:
+        return rv
+
+    with _trust_crl_lock:
+        # Another thread may have loaded it while we waited.
+        key = _FileKey(crl_path) if crl_path else None
+        with _trust_lock:
+            (found, rv) = _CachedCRL(key)
+        if found:
+            return rv
+
+        if key:
+            # We have one on disk from an earlier run; use it if it's current.
+            try:
+                with open(crl_path, "rb") as f:
+                    data = f.read()
+                (crl, next_update) = _LoadCRL(data)
+                if next_update and next_update > time.time():
+                    log.debug("Using cached CRL, valid until %s" % time.ctime(next_update))
+                    return _SetCRL((key, crl, next_update, hashlib.sha256(data).hexdigest()))
+            except:
+                log.debug("Could not load cached CRL", exc_info=True)
+
+        with _trust_lock:
+            _trust_stats["crl_fetches"] += 1
+        try:
+            crl_file = config.TryGetNetworkFile(url=IX_CRL,
+                                                reason="FetchCRL",
+                                                cache=True)
+            if not crl_file:
+                # TGNF will raise an exception in most cases.
+                raise Exception("Could not get CRL file")
+            try:
+                data = crl_file.read()
+            finally:
+                crl_file.close()
+        except:
+            log.error("Could not get CRL file %s" % IX_CRL)
+            return _SetCRL(None)
+
+        try:
+            (crl, next_update) = _LoadCRL(data)
+        except:
+            log.debug("Could not load CRL, ignoring for now", exc_info=True)
+            return _SetCRL(None)
+        return _SetCRL((_FileKey(crl_path) if crl_path else None, crl, next_update,
+                        hashlib.sha256(data).hexdigest()))
+
+def _TrustCerts(cert_file):
+    # Returns the list of parsed certificates in cert_file.
+    # Called with _trust_lock held.
+    import OpenSSL.crypto as Crypto
+
+    key = _FileKey(cert_file)
+    cached = _trust_certs.get(cert_file)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(cert_file, "r") as f:
+        regexp = r'-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----'
+        certs = re.findall(regexp, f.read(), re.DOTALL)
+    rv = []
+    for cert in certs:
+        try:
+            rv.append(Crypto.load_certificate(Crypto.FILETYPE_PEM, cert))
+        except:
+            # For now, just ignore
+            pass
+    _trust_certs[cert_file] = (key, rv)
+    return rv
+
+def TrustStore(config, cert_file):
+    # Returns (store, certificates) for verifying a manifest signed
+    # with a certificate in cert_file.  Raises an exception if the
+    # root CA or the certificates can't be loaded.
+    from . import IX_ROOT_CA_FILE
+    import OpenSSL.crypto as Crypto
+    global _trust_store
+
+    (crl, crl_digest) = _TrustCRL(config)
+    with _trust_lock:
+        hit = True
+        root_key = _FileKey(IX_ROOT_CA_FILE)
+        # Keyed by the CRL's contents, not the object, whose
+        # id() could be reused by a different one.
+        store_key = (root_key, crl_digest)
+        if _trust_store is None or _trust_store[0] != store_key:
+            hit = False
+            store = Crypto.X509Store()
+            store.set_flags(Crypto.X509StoreFlags.CRL_CHECK)
+            # Load our root CA
+            try:
+                with open(IX_ROOT_CA_FILE, "r") as f:
+                    root_ca = Crypto.load_certificate(Crypto.FILETYPE_PEM, f.read())
+                    store.add_cert(root_ca)
+            except:
+                log.debug("VerifySignature:  Could not load iX root CA", exc_info=True)
+                _trust_store = None
+                raise
+            if crl:
+                try:
+                    store.add_crl(crl)
+                except:
+                    log.debug("Could not load CRL, ignoring for now", exc_info=True)
+            _trust_store = (store_key, store)
+
+        cached = _trust_certs.get(cert_file)
+        if cached is None or cached[0] != _FileKey(cert_file):
+            hit = False
+        try:
+            certs = _TrustCerts(cert_file)
+        except:
+            log.error("Could not load certificates", exc_info=True)
+            raise
+
+        if hit:
+            _trust_stats["hits"] += 1
+        else:
+            _trust_stats["misses"] += 1
+        return (_trust_store[1], certs)
+
 
 def MakeString(obj):
     retval = json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': '), cls=ManifestEncoder)
@@ -205,6 +416,7 @@ class Manifest(object):
     _switch = None
     _timestamp = None
     _requireSignature = False
+    _signatureVerified = False
 
     def __init__(self, configuration=None, require_signature=False):
         if configuration is None:
@@ -225,7 +437,7 @@ class Manifest(object):
 
     def LoadFile(self, file):
         # Load a manifest from a file-like object.
-        # It's loaded as a json file, and then parsed
+        # It's loaded as a json file, and then parsed.
         if 'b' in file.mode:
             self._dict = json.loads(file.read().decode('utf8'))
         else:
@@ -234,6 +446,19 @@ class Manifest(object):
         self.Validate()
         return
 
+    def Copy(self):
+        # Returns a new Manifest with the same contents.
+        # The copy is not re-validated.
+        rv = Manifest(self._config, require_signature=self._requireSignature)
+        rv._root = self._root
+        rv._dict = copy.deepcopy(self._dict)
+        rv._signatureVerified = self._signatureVerified
+        return rv
+
+    def SignatureVerified(self):
+        # True if Validate() checked the signature, and it matched.
+        return self._signatureVerified
+
     def LoadPath(self, path):
         # Load a manifest from a path.
         with open(path, "rb") as f:
@@ -283,7 +508,9 @@ class Manifest(object):
                 log.debug("No signature in manifest")
         else:
             if self._requireSignature:
-                if not self.VerifySignature():
+                if self.VerifySignature():
+                    self._signatureVerified = True
+                else:
                     if self._requireSignature and SIGNATURE_FAILURE:
                         raise Exceptions.ManifestInvalidSignature("Signature verification failed")
                     if not self._requireSignature:
@@ -401,15 +628,13 @@ class Manifest(object):
         return
 
     def VerifySignature(self):
-        from . import IX_ROOT_CA_FILE, VERIFIER_HELPER, IX_CRL
+        from . import IX_ROOT_CA_FILE
         from . import SIGNATURE_FAILURE
 
         if self.Signature() is None:
             return not SIGNATURE_FAILURE
         # Probably need a way to ignore the signature
         else:
-            import subprocess
-            import tempfile
             from base64 import b64decode
             import OpenSSL.crypto as Crypto
             try:
@@ -423,52 +648,13 @@ class Manifest(object):
                 log.debug("VerifySignature:  Cannot find a required file")
                 return False
 
-            # First we create a store
-            store = Crypto.X509Store()
-            store.set_flags(Crypto.X509StoreFlags.CRL_CHECK)
-            # Load our root CA
+            # The store (root CA and CRL) and the parsed certificates
+            # are cached across calls.
             try:
-                with open(IX_ROOT_CA_FILE, "r") as f:
-                    root_ca = Crypto.load_certificate(Crypto.FILETYPE_PEM, f.read())
-                    store.add_cert(root_ca)
+                (store, certs) = TrustStore(self._config, cert_file)
             except:
-                log.debug("VerifySignature:  Could not load iX root CA", exc_info=True)
                 return False
-                
-            # Now need to get the CRL
-            crl_file = tempfile.NamedTemporaryFile(suffix=".pem")
-            if crl_file is None:
-                log.debug("Could not create CRL, ignoring for now")
-            else:
-                try:
-                    if not self._config.TryGetNetworkFile(
-                            url=IX_CRL,
-                            pathname=crl_file.name,
-                            reason="FetchCRL"
-                    ):
-                        # TGNF will raise an exception in most cases.
-                        raise Exception("Could not get CRL file")
-                except:
-                    log.error("Could not get CRL file %s" % IX_CRL)
-                    crl_file.close()
-                    crl_file = None
 
-            if crl_file:
-                try:
-                    crl = Crypto.load_crl(Crypto.FILETYPE_PEM, crl_file.read())
-                    store.add_crl(crl)
-                except:
-                    log.debug("Could not load CRL, ignoring for now", exc_info=True)
-                
-            # Now load the certificate files
-            try:
-                with open(cert_file, "r") as f:
-                    regexp = r'-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----'
-                    certs = re.findall(regexp, f.read(), re.DOTALL)
-            except:
-                log.error("Could not load certificates", exc_info=True)
-                return false
-                    
             # Almost done:  we need the signature as binary data
             try:
                 signature = b64decode(self.Signature())
@@ -481,9 +667,8 @@ class Manifest(object):
             tdata.pop(SIGNATURE_KEY, None)
             canonical = MakeString(tdata)
             
-            for cert in certs:
+            for test_cert in certs:
                 try:
-                    test_cert = Crypto.load_certificate(Crypto.FILETYPE_PEM, cert)
                     Crypto.verify(test_cert, signature, canonical, "sha256")
                     verified = True
                     break
@@ -655,22 +840,30 @@ class Manifest(object):
         if tmp_file or (not os.path.exists(prog_path)):
             # If tmp_file is set, we did not have a cache directory,
             # and so it's not possible to have it pre-downloaded.
-            # Need to download it
+            # Need to download it; the checksum is verified (and the
+            # file removed if it's wrong) as it is downloaded.
             # This may raise an exception, in which case we let it propagate up
-            self._config.TryGetNetworkFile(file="%s/%s" % (VALIDATION_DIR, v["Name"]),
-                                           pathname=prog_path,
-                                           reason="Validation Script").close()
-        with open(prog_path, "rb") as f:
-            hash = hashlib.sha256(f.read()).hexdigest()
+            try:
+                self._config.TryGetNetworkFile(file="%s/%s" % (VALIDATION_DIR, v["Name"]),
+                                               pathname=prog_path,
+                                               reason="Validation Script",
+                                               checksum=v["Checksum"]).close()
+            except Exceptions.ChecksumFailException:
+                if tmp_file:
+                    tmp_file.close()
+                raise Exceptions.ChecksumFailException("Validation program %s" % v["Name"])
+        else:
+            with open(prog_path, "rb") as f:
+                hash = hashlib.sha256(f.read()).hexdigest()
+            if hash != v["Checksum"]:
+                # Let's attempt to remove it, as well
+                try:
+                    os.remove(prog_path)
+                except:
+                    pass
+                raise Exceptions.ChecksumFailException("Validation program %s" % v["Name"])
         if tmp_file:
             tmp_file.close()
-        if hash != v["Checksum"]:
-            # Let's attempt to remove it, as well
-            try:
-                os.remove(prog_path)
-            except:
-                pass
-            raise Exceptions.ChecksumFailException("Validation program %s" % v["Name"])
         try:
             os.lchmod(prog_path, 0o555)
         except:
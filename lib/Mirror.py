@@ -0,0 +1,498 @@
+from __future__ import print_function
+import email.utils
+import http.server
+import logging
+import os
+import posixpath
+import re
+import threading
+import time
+
+from http import HTTPStatus
+
+import freenasOS.Configuration as Configuration
+import freenasOS.Manifest as Manifest
+from freenasOS import Avatar
+from freenasOS.Exceptions import UpdateNetworkFileNotFoundException
+
+log = logging.getLogger('freenasOS.Mirror')
+
+# Where a local mirror of the update server is kept, and
+# where "freenas-update serve" listens, by default.
+DEFAULT_MIRROR_DIR = "/var/db/system/update-mirror"
+DEFAULT_LISTEN_ADDRESS = ""
+DEFAULT_LISTEN_PORT = 8080
+
+# Files that are replaced in place on the update server (each
+# train's LATEST, the list of trains, and changelogs) are fetched
+# again once they're MUTABLE_TTL seconds old.  Everything else
+# (manifests by sequence, packages, validators) never changes.
+MUTABLE_TTL = 5 * 60
+MUTABLE_NAMES = ("LATEST", Configuration.TRAIN_FILE, "ChangeLog.txt")
+
+# Files upstream doesn't have aren't asked for again until
+# MISSING_TTL seconds later.
+MISSING_TTL = 60
+
+# How long a request for a file being downloaded waits for more
+# of it to arrive before checking again.
+STREAM_POLL = 0.1
+STREAM_CHUNK = 64 * 1024
+
+# How many files SyncMirror() fetches at once.
+SYNC_WORKERS = 4
+
+def IsMutable(path):
+    return posixpath.basename(path) in MUTABLE_NAMES
+
+
+class _Fill(object):
+    # A download into the mirror in progress.  Requests for the
+    # same file share it:  they read the partial file while it grows.
+    def __init__(self, path, part_path):
+        self.path = path
+        self.part_path = part_path
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+class MirrorCache(object):
+    """
+    A local copy of (part of) the update server, with the same
+    layout:  <train>/LATEST, the manifests, Packages/, and so on.
+    Files are fetched from upstream -- the update server, mirrors,
+    and master in conf -- the first time they're asked for; if
+    several requests miss on the same file at once, it's only
+    fetched once.  Mutable files (see IsMutable()) are fetched again
+    after ttl seconds; if that fails, the old copy is used.  A file
+    upstream doesn't have is reported missing for the next
+    missing_ttl seconds without asking again.
+    """
+    def __init__(self, directory=DEFAULT_MIRROR_DIR, conf=None, ttl=MUTABLE_TTL,
+                 missing_ttl=MISSING_TTL):
+        if conf is None:
+            conf = Configuration.SystemConfiguration()
+        self._directory = directory
+        self._conf = conf
+        self._ttl = ttl
+        self._missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        self._fills = {}
+        self._missing = {}
+        os.makedirs(self._directory, mode=0o755, exist_ok=True)
+
+    def Directory(self):
+        return self._directory
+
+    def Configuration(self):
+        return self._conf
+
+    def Normalize(self, path):
+        # path (a URL path, relative to the top of the update
+        # server) cleaned up, or None if it would leave the mirror.
+        path = posixpath.normpath("/" + path.split("?", 1)[0].lstrip("/")).lstrip("/")
+        if not path or "\0" in path:
+            return None
+        return path
+
+    def LocalPath(self, path):
+        # The file in the mirror for path, or None.
+        path = self.Normalize(path)
+        if path is None:
+            return None
+        return os.path.join(self._directory, *path.split("/"))
+
+    def Fresh(self, path):
+        # Whether the mirror's copy of path can be used as is.
+        local_path = self.LocalPath(path)
+        try:
+            st = os.stat(local_path)
+        except (OSError, TypeError):
+            return False
+        if IsMutable(path):
+            return (time.time() - st.st_mtime) < self._ttl
+        return True
+
+    def _Run(self, fill):
+        # Download fill.path into fill.part_path, and move it into place.
+        local_path = self.LocalPath(fill.path)
+        try:
+            os.makedirs(os.path.dirname(local_path), mode=0o755, exist_ok=True)
+            try:
+                os.unlink(fill.part_path)
+            except OSError:
+                pass
+            # Create it now, so readers have something to open.
+            open(fill.part_path, "wb").close()
+            fill.started.set()
+            f = self._conf.TryGetNetworkFile(file=fill.path,
+                                             pathname=fill.part_path,
+                                             reason="MirrorFill",
+                                             ignore_space=True,
+                                             sequential=True)
+            if f is None:
+                raise UpdateNetworkFileNotFoundException("Unable to fetch %s" % fill.path)
+            f.close()
+            os.rename(fill.part_path, local_path)
+            log.debug("Mirrored %s" % fill.path)
+        except BaseException as e:
+            log.error("Unable to mirror %s: %s" % (fill.path, str(e)))
+            fill.error = e
+            if isinstance(e, UpdateNetworkFileNotFoundException):
+                self._Missing(fill.path)
+            try:
+                os.unlink(fill.part_path)
+            except OSError:
+                pass
+        finally:
+            with self._lock:
+                self._fills.pop(fill.path, None)
+            fill.started.set()
+            fill.done.set()
+        return
+
+    def _Missing(self, path):
+        # Remember that upstream doesn't have path, and forget
+        # about anything that's been missing for long enough.
+        now = time.time()
+        with self._lock:
+            for (missing_path, when) in list(self._missing.items()):
+                if now - when >= self._missing_ttl:
+                    del self._missing[missing_path]
+            self._missing[path] = now
+        return
+
+    def Fill(self, path):
+        """
+        Start fetching path into the mirror, unless that's already
+        happening.  Returns the _Fill for it, or None if the mirror's
+        copy is already fresh.  If upstream didn't have path recently,
+        the _Fill returned has already failed.
+        """
+        path = self.Normalize(path)
+        with self._lock:
+            fill = self._fills.get(path)
+            if fill:
+                return fill
+            if self.Fresh(path):
+                return None
+            fill = _Fill(path, "%s.%d.part" % (self.LocalPath(path), threading.get_ident()))
+            missing = self._missing.get(path)
+            if missing is not None and time.time() - missing < self._missing_ttl:
+                fill.error = UpdateNetworkFileNotFoundException("%s is not upstream" % path)
+                fill.started.set()
+                fill.done.set()
+                return fill
+            self._fills[path] = fill
+        t = threading.Thread(target=self._Run, args=(fill,), name="freenasOS-MirrorFill", daemon=True)
+        t.start()
+        return fill
+
+    def Fetch(self, path):
+        """
+        Return the mirror's copy of path, fetching it (or waiting
+        for another request to) if needed.  An old copy of a mutable
+        file is returned if it can't be fetched again.
+        Raises UpdateNetworkFileNotFoundException if there's no copy.
+        """
+        local_path = self.LocalPath(path)
+        if local_path is None:
+            raise UpdateNetworkFileNotFoundException("Bad path %s" % path)
+        fill = self.Fill(path)
+        if fill:
+            fill.done.wait()
+            if fill.error:
+                if os.path.exists(local_path):
+                    log.debug("Using old copy of %s" % path)
+                    return local_path
+                raise fill.error
+        return local_path
+
+
+class MirrorRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves a MirrorCache (the server's mirror attribute) over HTTP.
+    Files already in the mirror are served with support for ranges
+    and If-None-Match; a miss is streamed (chunked) to the client as
+    it arrives from upstream.
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "freenas-update"
+
+    def log_message(self, format, *args):
+        log.debug("%s: %s" % (self.address_string(), format % args))
+
+    def do_HEAD(self):
+        self.SendFile(head=True)
+
+    def do_GET(self):
+        self.SendFile()
+
+    def SendFile(self, head=False):
+        mirror = self.server.mirror
+        path = self.path.split("?", 1)[0]
+        local_path = mirror.LocalPath(path)
+        if local_path is None or os.path.isdir(local_path):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        fill = None
+        try:
+            if IsMutable(path) or head:
+                local_path = mirror.Fetch(path)
+            else:
+                fill = mirror.Fill(path)
+        except UpdateNetworkFileNotFoundException:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        except BaseException:
+            self.send_error(HTTPStatus.BAD_GATEWAY)
+            return
+        if fill:
+            self.StreamFill(fill)
+        else:
+            self.SendLocalFile(local_path, head=head)
+        return
+
+    def SendLocalFile(self, local_path, head=False):
+        try:
+            f = open(local_path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = '"%x-%x"' % (int(st.st_mtime), size)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start = 0
+            end = size - 1
+            m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", "").strip())
+            if m:
+                start = int(m.group(1))
+                if m.group(2):
+                    end = min(int(m.group(2)), end)
+                if start >= size:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            else:
+                self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", email.utils.formatdate(st.st_mtime, usegmt=True))
+            self.end_headers()
+            if head:
+                return
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(STREAM_CHUNK, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+        return
+
+    def StreamFill(self, fill):
+        # Send the file being downloaded by fill as it grows.  The
+        # length isn't known yet, so it's sent chunked; if the download
+        # fails part way through, the connection is dropped without
+        # the last chunk, so the client knows it didn't get all of it.
+        fill.started.wait()
+        try:
+            f = open(fill.part_path, "rb")
+        except OSError:
+            f = None
+        if f is None:
+            # Already finished (or failed) and moved out of the way.
+            fill.done.wait()
+            if fill.error:
+                if isinstance(fill.error, UpdateNetworkFileNotFoundException):
+                    self.send_error(HTTPStatus.NOT_FOUND)
+                else:
+                    self.send_error(HTTPStatus.BAD_GATEWAY)
+            else:
+                self.SendLocalFile(self.server.mirror.LocalPath(fill.path))
+            return
+        with f:
+            data = f.read(STREAM_CHUNK)
+            while not data and not fill.done.is_set():
+                fill.done.wait(STREAM_POLL)
+                data = f.read(STREAM_CHUNK)
+            if not data and fill.error:
+                if isinstance(fill.error, UpdateNetworkFileNotFoundException):
+                    self.send_error(HTTPStatus.NOT_FOUND)
+                else:
+                    self.send_error(HTTPStatus.BAD_GATEWAY)
+                return
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            while True:
+                if data:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                elif fill.done.is_set():
+                    # Anything written just before it finished?
+                    data = f.read(STREAM_CHUNK)
+                    if data:
+                        continue
+                    break
+                else:
+                    fill.done.wait(STREAM_POLL)
+                data = f.read(STREAM_CHUNK)
+            if fill.error:
+                log.error("Transfer of %s to %s cut short" % (fill.path, self.address_string()))
+                self.close_connection = True
+                return
+            self.wfile.write(b"0\r\n\r\n")
+        return
+
+
+class MirrorServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, mirror, address=DEFAULT_LISTEN_ADDRESS, port=DEFAULT_LISTEN_PORT,
+                 handler=MirrorRequestHandler):
+        self.mirror = mirror
+        super(MirrorServer, self).__init__((address, port), handler)
+
+
+def Serve(directory=DEFAULT_MIRROR_DIR, address=DEFAULT_LISTEN_ADDRESS,
+          port=DEFAULT_LISTEN_PORT, conf=None):
+    """
+    Serve the mirror in directory over HTTP until interrupted,
+    filling it from upstream on demand.  Other systems can use
+    it by pointing an update server's url and master at it.
+    """
+    mirror = MirrorCache(directory, conf=conf)
+    server = MirrorServer(mirror, address=address, port=port)
+    log.info("Serving update mirror %s on %s:%d" % (directory, address or "*", server.server_port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    return
+
+
+def _SyncFile(conf, directory, path, checksum, verify=False):
+    # Make sure the mirror in directory has path, with the given
+    # checksum.  Returns the number of bytes fetched (0 if it was
+    # already there, or came from the package store).
+    local_path = os.path.join(directory, *path.split("/"))
+    if os.path.exists(local_path):
+        if not verify:
+            return 0
+        with open(local_path, "rb") as f:
+            if Configuration.ChecksumFile(f) == checksum:
+                return 0
+        log.error("Mirror copy of %s is corrupt, fetching it again" % path)
+        os.unlink(local_path)
+    os.makedirs(os.path.dirname(local_path), mode=0o755, exist_ok=True)
+
+    store = conf.PackageStore()
+    if store and checksum and store.LinkInto(checksum, local_path):
+        return 0
+    # Interrupted syncs pick up where they left off.
+    part_path = local_path + ".part"
+    f = conf.TryGetNetworkFile(file=path,
+                               pathname=part_path,
+                               reason="MirrorSync",
+                               intr_ok=True,
+                               ignore_space=True,
+                               checksum=checksum)
+    if f is None:
+        raise UpdateNetworkFileNotFoundException("Unable to fetch %s" % path)
+    f.close()
+    size = os.path.getsize(part_path)
+    os.rename(part_path, local_path)
+    log.debug("Synced %s (%d bytes)" % (path, size))
+    return size
+
+
+def SyncMirror(directory=DEFAULT_MIRROR_DIR, trains=None, conf=None,
+               workers=SYNC_WORKERS, deltas=True, verify=False,
+               require_signature=True):
+    """
+    Bring the mirror in directory up to date with the latest
+    sequence of each train in trains (by default, every train the
+    update server lists).  Only the manifests, packages, deltas
+    (unless deltas is False), and validation programs the mirror
+    doesn't have are fetched, workers at a time, and each is checked
+    against the manifest's checksum.  If verify is set, files already
+    in the mirror are checked as well.  A train's LATEST is only
+    replaced once everything it refers to is in place, so the mirror
+    can be served while it's being synced.
+    Returns a dictionary, keyed by train, of the sequence now in the
+    mirror, and how many files and bytes were fetched for it.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if conf is None:
+        conf = Configuration.SystemConfiguration()
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+    if trains is None:
+        trains = conf.AvailableTrains()
+        if not trains:
+            raise UpdateNetworkFileNotFoundException("Unable to get the list of trains")
+        trains = sorted(trains.keys())
+        # The list of trains is part of the mirror too.
+        MirrorCache(directory, conf=conf, ttl=0).Fetch(Configuration.TRAIN_FILE)
+
+    rv = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for train in trains:
+            latest = "%s/LATEST" % train
+            mani_file = conf.TryGetNetworkFile(file=latest, reason="MirrorSync")
+            if mani_file is None:
+                raise UpdateNetworkFileNotFoundException("Unable to fetch %s" % latest)
+            with mani_file:
+                contents = mani_file.read()
+                mani_file.seek(0)
+                manifest = Manifest.Manifest(configuration=conf, require_signature=require_signature)
+                manifest.LoadFile(mani_file)
+
+            files = []
+            for pkg in manifest.Packages():
+                files.append(("Packages/%s" % pkg.FileName(), pkg.Checksum()))
+                if deltas:
+                    for upd in pkg.Updates():
+                        files.append(("Packages/%s" % pkg.FileName(upd.Version()), upd.Checksum()))
+            for v in manifest.ValidationProgramList():
+                files.append(("%s/%s" % (Manifest.VALIDATION_DIR, v["Name"]), v["Checksum"]))
+
+            log.debug("SyncMirror(%s):  sequence %s, %d files" % (train, manifest.Sequence(), len(files)))
+            futures = [executor.submit(_SyncFile, conf, directory, path, checksum, verify)
+                       for (path, checksum) in files]
+            # Wait for all of them, even if one fails, so nothing is
+            # left writing into the mirror.
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                log.error("SyncMirror(%s):  %d files could not be fetched" % (train, len(errors)))
+                raise errors[0]
+            fetched = [f.result() for f in futures]
+
+            # Everything's there, so the manifest can go in, and LATEST last.
+            for path in ("%s/%s-%s" % (Avatar(), train, manifest.Sequence()), latest):
+                local_path = os.path.join(directory, *path.split("/"))
+                os.makedirs(os.path.dirname(local_path), mode=0o755, exist_ok=True)
+                tmp_path = local_path + ".part"
+                with open(tmp_path, "wb") as f:
+                    f.write(contents)
+                os.rename(tmp_path, local_path)
+            rv[train] = {
+                "Sequence" : manifest.Sequence(),
+                "Files" : len([n for n in fetched if n]),
+                "Bytes" : sum(fetched),
+            }
+    return rv
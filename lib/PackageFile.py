@@ -38,6 +38,48 @@ def PackageServices(m):
     return m[kPkgServicesKey] if kPkgServicesKey in m else None
 
 
+def NormalizePath(name, prefix=None):
+    # The absolute path a manifest entry, or tar member, names.
+    # Either may or may not have a leading "/" (tar removes it),
+    # or "./".  If prefix is given, name is relative to it (simply
+    # appended, as pkg does).  Trailing slashes are left alone.
+    if prefix:
+        name = prefix + name
+    if name.startswith("./"):
+        name = name[2:]
+    return "/" + name.lstrip("/")
+
+
+class PathIndex(object):
+    """
+    The files and directories in a package manifest, keyed by
+    NormalizePath(), so a tar member can be looked up with at most
+    two probes:  its own name, and its name under the prefix.  Each
+    path maps to (hash, type), type being "file" or "dir"; directories
+    have no hash ("-").  If a path is both, the file wins.
+    """
+    def __init__(self, files=None, dirs=None, prefix=None):
+        self._prefix = prefix
+        self._index = {}
+        for path in (dirs or {}):
+            self._index[NormalizePath(path)] = ("-", "dir")
+        for (path, hash) in (files or {}).items():
+            self._index[NormalizePath(path)] = (hash, "file")
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return self.Lookup(name) is not None
+
+    def Lookup(self, name):
+        # Returns (hash, type) for the tar member name, or None.
+        rv = self._index.get(NormalizePath(name))
+        if rv is None and self._prefix is not None:
+            rv = self._index.get(NormalizePath(name, self._prefix))
+        return rv
+
+
 def FindManifest(tf):
     # Find the file named "+MANIFEST".
     # Also position the tarfile to be at the first non-+-named file.
@@ -240,31 +282,26 @@ def DiffPackageFiles(pkg1, pkg2, output_file=None, scripts=None, force_output=Fa
     # we need to include it in the delta package.
     # This adds some significant time to the processing.
     old_files = {}
-    file_keys = []
-    if kPkgRemovedFilesKey in new_manifest:
-        file_keys.extend(new_manifest[kPkgRemovedFilesKey])
-    if kPkgRemovedDirsKey in new_manifest:
-        file_keys.extend(new_manifest[kPkgRemovedDirsKey])
-    if kPkgFilesKey in new_manifest:
-        file_keys.extend(new_manifest[kPkgFilesKey].keys())
-    if kPkgDirsKey in new_manifest:
-        file_keys.extend(new_manifest[kPkgDirsKey].keys())
+    file_keys = set()
+    for key in (kPkgRemovedFilesKey, kPkgRemovedDirsKey, kPkgFilesKey, kPkgDirsKey):
+        if key in new_manifest:
+            file_keys.update(NormalizePath(name) for name in new_manifest[key])
 
     for entry in pkg1_tarfile.getmembers():
         if entry.name.startswith("+"):
             continue
-        if entry.name in file_keys:
-            continue
-        if "/" + entry.name in file_keys:
+        name = NormalizePath(entry.name)
+        if name in file_keys:
             continue
-        old_files[entry.name if entry.name.startswith("/") else "/" + entry.name] = GetTarMeta(entry)
+        old_files[name] = GetTarMeta(entry)
     new_files = {}
     for entry in pkg2_tarfile.getmembers():
         if entry.name.startswith("+"):
             continue
-        if entry.name in file_keys:
+        name = NormalizePath(entry.name)
+        if name in file_keys:
             continue
-        new_files[entry.name if entry.name.startswith("/") else "/" + entry.name] = GetTarMeta(entry)
+        new_files[name] = GetTarMeta(entry)
         
     for entry in old_files.keys():
         if old_files[entry] != new_files[entry]:
@@ -333,11 +370,14 @@ def DiffPackageFiles(pkg1, pkg2, output_file=None, scripts=None, force_output=Fa
     
     # Now copy files from pkg2 to new_tf
     # We want to do this by going through pkg2_tarfile.
-    search_dict = dict(diffs[kPkgFilesKey], ** diffs[kPkgDirsKey])
+    search_dict = {}
+    for key in (kPkgFilesKey, kPkgDirsKey):
+        for (name, value) in diffs[key].items():
+            search_dict[NormalizePath(name)] = value
     while member is not None:
         if verbose:
             print("Member {0}".format(member.name), file=sys.stderr)
-        fname = member.name if member.name in search_dict else "/" + member.name
+        fname = NormalizePath(member.name)
         if verbose:
             print("Looking at member {0}".format(member.name), file=sys.stderr)
         if fname in search_dict:
@@ -359,6 +399,6 @@ def DiffPackageFiles(pkg1, pkg2, output_file=None, scripts=None, force_output=Fa
             search_dict.pop(fname)
             if len(search_dict) == 0:
                 break
-        member = next(pkg2_tarfile)
+        member = pkg2_tarfile.next()
     new_tf.close()
     return output_file
@@ -0,0 +1,188 @@
+from __future__ import print_function
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+log = logging.getLogger('freenasOS.PackageStore')
+
+# Where the store lives, relative to the configuration's
+# temporary directory.
+STORE_DIR = "package-store"
+
+# How much the store may hold before the least-recently used
+# entries are removed.
+DEFAULT_STORE_SIZE = 2 * 1024 * 1024 * 1024
+
+def _Checksum(path):
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for piece in iter(lambda: f.read(1024 * 1024), b''):
+            hash.update(piece)
+    return hash.hexdigest()
+
+def _LinkOrCopy(src, dst):
+    # Hard-link src to dst, replacing dst; if they're on different
+    # filesystems (or linking isn't allowed), copy it instead.
+    tmp = "%s.%d.tmp" % (dst, threading.get_ident())
+    try:
+        os.unlink(tmp)
+    except OSError:
+        pass
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        log.debug("Cannot link %s to %s (%s), copying" % (src, dst, str(e)))
+        try:
+            shutil.copyfile(src, tmp)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+    os.rename(tmp, dst)
+    return
+
+def Unshare(path):
+    # If path has other hard links (such as a store entry linked
+    # into an update directory), replace it with a copy of its own,
+    # so that writing to it can't change the others.  Returns True
+    # if it was copied.
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if st.st_nlink <= 1 or not os.path.isfile(path):
+        return False
+    tmp = "%s.%d.tmp" % (path, threading.get_ident())
+    try:
+        shutil.copyfile(path, tmp)
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    log.debug("Copied %s, so it isn't shared" % path)
+    return True
+
+class PackageStore(object):
+    """
+    A content-addressed store of package files, shared by all
+    update directories.  Files are named by their SHA256 checksum,
+    so the same full or delta package is only downloaded once, no
+    matter which update, or train, it was for.  Hits are hard-linked
+    (or copied, if that isn't possible) into the update directory.
+    The store is kept under max_size bytes by removing the
+    least-recently used files; an entry's mtime is its last use.
+    Anything that writes to a file which may be linked to an entry
+    has to Unshare() it first.
+    """
+    def __init__(self, path, max_size=DEFAULT_STORE_SIZE):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self._path, mode=0o755, exist_ok=True)
+
+    def __repr__(self):
+        return "PackageStore(path={}, max_size={})".format(self._path, self._max_size)
+
+    def Directory(self):
+        return self._path
+
+    def MaxSize(self):
+        return self._max_size
+
+    def Path(self, checksum):
+        return os.path.join(self._path, checksum[:2], checksum)
+
+    def Lookup(self, checksum):
+        # Returns the path of the entry for checksum, or None.
+        # The entry is checked before it's returned, and removed
+        # if it doesn't match.
+        path = self.Path(checksum)
+        if not os.path.exists(path):
+            return None
+        try:
+            if _Checksum(path) != checksum:
+                log.error("Package store entry %s is corrupt, removing it" % path)
+                os.unlink(path)
+                return None
+            os.utime(path)
+        except OSError as e:
+            log.debug("Unable to use package store entry %s: %s" % (path, str(e)))
+            return None
+        return path
+
+    def LinkInto(self, checksum, dest):
+        # Put the entry for checksum at dest.  Returns dest,
+        # or None if it isn't in the store.
+        path = self.Lookup(checksum)
+        if path is None:
+            return None
+        try:
+            _LinkOrCopy(path, dest)
+        except OSError as e:
+            log.debug("Unable to copy %s to %s: %s" % (path, dest, str(e)))
+            return None
+        log.debug("Using %s from the package store" % dest)
+        return dest
+
+    def Add(self, path, checksum):
+        # Add the file at path, which has already been verified
+        # to have the given checksum.
+        entry = self.Path(checksum)
+        try:
+            if not os.path.exists(entry):
+                os.makedirs(os.path.dirname(entry), mode=0o755, exist_ok=True)
+                _LinkOrCopy(path, entry)
+            else:
+                os.utime(entry)
+        except OSError as e:
+            log.debug("Unable to add %s to the package store: %s" % (path, str(e)))
+            return False
+        self.Evict()
+        return True
+
+    def Entries(self):
+        # Returns a list of (path, size, mtime) for every entry.
+        rv = []
+        for (dirpath, dirnames, filenames) in os.walk(self._path):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                p = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(p)
+                except OSError:
+                    continue
+                rv.append((p, st.st_size, st.st_mtime))
+        return rv
+
+    def Size(self):
+        return sum(size for (path, size, mtime) in self.Entries())
+
+    def Evict(self, max_size=None):
+        # Remove the least-recently used entries until the
+        # store is no bigger than max_size (default, the store's limit).
+        if max_size is None:
+            max_size = self._max_size
+        with self._lock:
+            entries = sorted(self.Entries(), key=lambda e: e[2])
+            total = sum(size for (path, size, mtime) in entries)
+            for (path, size, mtime) in entries:
+                if total <= max_size:
+                    break
+                log.debug("Removing %s from the package store" % path)
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError as e:
+                    log.debug("Unable to remove %s: %s" % (path, str(e)))
+        return
@@ -47,8 +47,11 @@ class Train(object):
     def LastCheckedTime(self):
         return self._time
 
-    def SetLastCheckedTime(self, time=str(int(time.time()))):
-        self._time = time
+    def SetLastCheckedTime(self, checked=None):
+        # Defaults to now.
+        if checked is None:
+            checked = str(int(time.time()))
+        self._time = checked
         return
 
     def Notice(self):
@@ -11,6 +11,7 @@ import shutil
 import fcntl
 import errno
 import tarfile
+import threading
 
 try:
     import libzfs
@@ -947,9 +948,91 @@ def CheckForUpdates(handler=None, train=None, cache_dir=None, diff_handler=None)
     return new_manifest
 
 
+class DownloadProgress(object):
+    """
+    Combine the progress callbacks for packages being downloaded
+    concurrently.  The overall progress is reported using the same
+    protocol as a serial download -- check_handler is told which
+    package we are "on", and get_handler gets the percentage within
+    that package -- so existing handlers work unchanged.  Calls to
+    the handlers are serialized.
+    """
+    def __init__(self, pkgList, check_handler=None, get_handler=None):
+        self._lock = threading.Lock()
+        self._pkgList = pkgList
+        self._check_handler = check_handler
+        self._get_handler = get_handler
+        self._done = [0.0] * len(pkgList)
+        self._rates = {}
+        self._index = 0
+
+    def _report(self, method, filename, size=None):
+        # Must be called with the lock held
+        total = sum(self._done)
+        indx = min(int(total), len(self._pkgList) - 1)
+        if indx + 1 != self._index:
+            self._index = indx + 1
+            if self._check_handler:
+                self._check_handler(self._index, pkg=self._pkgList[indx], pkgList=self._pkgList)
+        if self._get_handler and method:
+            progress = max(0, min(100, int((total - indx) * 100)))
+            self._get_handler(
+                method,
+                filename,
+                size=size,
+                progress=progress,
+                download_rate=sum(self._rates.values()) or None,
+            )
+
+    def Start(self):
+        with self._lock:
+            self._report(None, None)
+
+    def Handler(self, indx):
+        """
+        Return a get_handler-style callback for the package at indx.
+        """
+        def handler(method, filename, size=None, progress=None, download_rate=None):
+            with self._lock:
+                if progress is not None:
+                    self._done[indx] = progress / 100.0
+                if download_rate is not None:
+                    self._rates[indx] = download_rate
+                self._report(method, filename, size)
+        return handler
+
+    def Finished(self, indx):
+        with self._lock:
+            self._done[indx] = 1.0
+            self._rates.pop(indx, None)
+            self._report("network", self._pkgList[indx].FileName())
+
+
+def DownloadPackages(conf, pkgList, directory, workers=1,
+                     get_handler=None, check_handler=None,
+                     pkg_type=None, ignore_space=False):
+    """
+    Download the package files in pkgList into directory, using up
+    to workers concurrent transfers.  The first failure (e.g., a
+    checksum failure) cancels the remaining transfers; once all
+    of the workers have stopped, that exception is raised.
+    Partially-downloaded files are left in place, so a later attempt
+    can resume them.
+    This is a synchronous wrapper for AsyncDownloader.DownloadPackages().
+    """
+    from .AsyncDownload import AsyncDownloader, RunSync
+
+    with AsyncDownloader(conf, concurrency=workers) as downloader:
+        return RunSync(downloader.DownloadPackages(
+            pkgList, directory,
+            get_handler=get_handler, check_handler=check_handler,
+            pkg_type=pkg_type, ignore_space=ignore_space,
+        ))
+
+
 def DownloadUpdate(train, directory, get_handler=None,
                    check_handler=None, pkg_type=None,
-                   ignore_space=False):
+                   ignore_space=False, workers=1, downloader=None):
     """
     Download, if necessary, the LATEST update for train; download
     delta packages if possible.  Checks to see if the existing content
@@ -958,6 +1041,9 @@ def DownloadUpdate(train, directory, get_handler=None,
     allow it to determine if a reboot into a different boot environment
     has happened.  This will remove the existing content if it decides
     it has to redownload for any reason.
+    If workers is more than 1, that many package files are downloaded
+    at once (see DownloadPackages()); downloader, if given, is used
+    instead of DownloadPackages(), with the same arguments.
     Returns True if an update is available, False if no update is avialbale.
     Raises exceptions on errors.
     """
@@ -1098,21 +1184,27 @@ def DownloadUpdate(train, directory, get_handler=None,
         log.debug("Update does%s seem to require a reboot" % "" if reboot_required else " not")
 
         # Next steps:  download the package files.
-        for indx, pkg in enumerate(download_packages):
-            # This is where we find out for real if a reboot is required.
-            # To do that, we may need to know which update was downloaded.
-            if check_handler:
-                check_handler(indx + 1, pkg=pkg, pkgList=download_packages)
-            pkg_file = conf.FindPackageFile(
-                pkg, save_dir=directory, handler=get_handler, pkg_type=pkg_type,
-                ignore_space=ignore_space
-            )
-            if pkg_file is None:
-                log.error("Could not download package file for %s" % pkg.Name())
-                RemoveUpdate(directory)
-                return False
-            else:
-                pkg_file.close()
+        if workers and workers > 1 and len(download_packages) > 1:
+            (downloader or DownloadPackages)(
+                conf, download_packages, directory, workers=workers,
+                get_handler=get_handler, check_handler=check_handler,
+                pkg_type=pkg_type, ignore_space=ignore_space)
+        else:
+            for indx, pkg in enumerate(download_packages):
+                # This is where we find out for real if a reboot is required.
+                # To do that, we may need to know which update was downloaded.
+                if check_handler:
+                    check_handler(indx + 1, pkg=pkg, pkgList=download_packages)
+                pkg_file = conf.FindPackageFile(
+                    pkg, save_dir=directory, handler=get_handler, pkg_type=pkg_type,
+                    ignore_space=ignore_space
+                )
+                if pkg_file is None:
+                    log.error("Could not download package file for %s" % pkg.Name())
+                    RemoveUpdate(directory)
+                    return False
+                else:
+                    pkg_file.close()
 
         # Almost done:  get a changelog if one exists for the train
         # If we can't get it, we don't care.
@@ -1290,12 +1382,16 @@ def ApplyUpdate(directory,
                 force_reboot=False,
                 ignore_space=False,
                 progressFunc=None,
-                force_trampoline=None
+                force_trampoline=None,
+                pipeline=False
                 ):
     """
     Apply the update in <directory>.  As with PendingUpdates(), it will
     have to verify the contents before it actually installs them, so
     it has the same behaviour with incomplete or invalid content.
+    If pipeline is set, each package is installed as soon as its file
+    has been found and verified, while the next ones are being checked,
+    rather than checking all of them first.
     """
     rv = False
     conf = Configuration.SystemConfiguration()
@@ -1337,6 +1433,7 @@ def ApplyUpdate(directory,
     service_list = None
     deleted_packages = []
     updated_packages = []
+    package_files = []
     if "Packages" in changes:
         for (pkg, op, old) in changes["Packages"]:
             if op == "delete":
@@ -1346,9 +1443,14 @@ def ApplyUpdate(directory,
             elif op == "install":
                 log.debug("Install package %s" % pkg.Name())
                 updated_packages.append(pkg)
+                package_files.append(pkg.FileName())
             elif op == "upgrade":
                 log.debug("Upgrade package %s-%s to %s-%s" % (old.Name(), old.Version(), pkg.Name(), pkg.Version()))
                 updated_packages.append(pkg)
+                if os.path.exists(os.path.join(directory, pkg.FileName(old.Version()))):
+                    package_files.append(pkg.FileName(old.Version()))
+                else:
+                    package_files.append(pkg.FileName())
             else:
                 log.error("Unknown package operation %s for %s" % (op, pkg.Name()))
 
@@ -1367,8 +1469,9 @@ def ApplyUpdate(directory,
         log.debug("ApplyUpdate: force_trampoline = {} (bool {})".format(force_trampoline, bool(force_trampoline)))
         installer.trampoline = bool(force_trampoline)
 
-    installer.GetPackages(pkgList=updated_packages)
-    log.debug("Installer got packages %s" % installer.Packages())
+    if not pipeline:
+        installer.GetPackages(pkgList=updated_packages)
+        log.debug("Installer got packages %s" % installer.Packages())
     
     """
     There is no way around this:  this is a horrible hack.  It
@@ -1388,12 +1491,22 @@ def ApplyUpdate(directory,
         return rv
 
     space_needed = 0
-    for f in installer.Packages():
-        [(dc, fobj)] = f.items()
-        try:
-            space_needed += ActualSize(fobj)
-        except:
-            pass
+    if pipeline:
+        # The installer doesn't have the files yet, so look at
+        # the ones in the cache directory.
+        for name in package_files:
+            try:
+                with open(os.path.join(directory, name), "rb") as fobj:
+                    space_needed += ActualSize(fobj)
+            except:
+                pass
+    else:
+        for f in installer.Packages():
+            [(dc, fobj)] = f.items()
+            try:
+                space_needed += ActualSize(fobj)
+            except:
+                pass
         
     if not ignore_space and not PruneClones(required=space_needed):
         raise UpdateInsufficientSpace("Insufficient space to install update")
@@ -1550,17 +1663,32 @@ def ApplyUpdate(directory,
     # Easy peasy, right?
 
     try:
-        # Remove any deleted packages
-        for pkg in deleted_packages:
-            log.debug("About to delete package %s from %s" % (pkg.Name(), mount_point))
-            if conf.PackageDB(mount_point).RemovePackageContents(pkg.Name()) == False:
-                s = "Unable to remove contents for package %s" % pkg.Name()
-                if mount_point:
-                    UnmountClone(new_boot_name, mount_point)
-                    mount_point = None
-                    DeleteClone(new_boot_name)
-                raise UpdatePackageException(s)
-            conf.PackageDB(mount_point).RemovePackage(pkg.Name())
+        if pipeline:
+            # The package files are checked while the deleted packages
+            # are removed, and the others installed; if one is bad, the
+            # boot environment is cleaned up as below.
+            installer.GetPackages(pkgList=updated_packages, pipeline=True)
+
+        # Remove any deleted packages, using one database connection;
+        # each package's removal is committed when it's done.
+        failed = None
+        if deleted_packages:
+            with conf.PackageDB(mount_point) as pkgdb:
+                for pkg in deleted_packages:
+                    log.debug("About to delete package %s from %s" % (pkg.Name(), mount_point))
+                    if pkgdb.RemovePackageContents(pkg.Name()) == False:
+                        pkgdb.Rollback()
+                        failed = pkg
+                        break
+                    pkgdb.RemovePackage(pkg.Name())
+                    pkgdb.Commit()
+        if failed:
+            s = "Unable to remove contents for package %s" % failed.Name()
+            if mount_point:
+                UnmountClone(new_boot_name, mount_point)
+                mount_point = None
+                DeleteClone(new_boot_name)
+            raise UpdatePackageException(s)
 
         # Now to start installing the packages
         rv = False
@@ -1600,6 +1728,7 @@ def ApplyUpdate(directory,
     except BaseException as e:
         # Cleanup code is entirely different for reboot vs non reboot
         log.error("Update got exception during update: %s", e, exc_info=True)
+        installer.CancelPackages()
         if reboot:
             if mount_point:
                 UnmountClone(new_boot_name, mount_point)